@@ -0,0 +1,173 @@
+import numpy as np
+
+class connection_scan:
+
+    # Connection Scan Algorithm on a flat, time-sorted array of connections. A
+    # connection is one ride between two consecutive stops of a trip. Transfers
+    # are footpaths between locations, a connection can be boarded at a location
+    # once the arrival there plus the transfer time lies before its departure.
+
+    # Connections are copied to Python lists in chunks of this size while scanning
+    scan_chunk_size = 4096
+
+    def __init__(self, dep_locs, arr_locs, dep_timestamps, arr_timestamps, trips, transfers, num_locations):
+
+        # The connections of a trip must be given in travel order, transfers as
+        # rows of (from_loc, to_loc, transfer_time)
+
+        num_connections = len(dep_locs)
+
+        self.num_locations = num_locations
+
+        self.order = np.lexsort((np.arange(num_connections), arr_timestamps, dep_timestamps))
+
+        self.dep_locs = np.asarray(dep_locs, dtype=np.int64)[self.order]
+        self.arr_locs = np.asarray(arr_locs, dtype=np.int64)[self.order]
+        self.dep_timestamps = np.asarray(dep_timestamps, dtype=np.int64)[self.order]
+        self.arr_timestamps = np.asarray(arr_timestamps, dtype=np.int64)[self.order]
+        self.trips = np.asarray(trips, dtype=np.int64)[self.order]
+
+        # Scan position of every connection, in travel order per trip
+        ranks = np.empty(num_connections, dtype=np.int64)
+        ranks[self.order] = np.arange(num_connections)
+        trip_order = np.argsort(np.asarray(trips, dtype=np.int64), kind='stable')
+        self.trip_connections = ranks[trip_order]
+        self.trip_positions = np.empty(num_connections, dtype=np.int64)
+        self.trip_positions[self.trip_connections] = np.arange(num_connections)
+
+        transfers = np.asarray(transfers, dtype=np.int64).reshape(-1, 3)
+        transfers = transfers[np.argsort(transfers[:, 0], kind='stable')]
+
+        self.transfer_offsets = np.zeros(num_locations + 1, dtype=np.int64)
+        np.cumsum(np.bincount(transfers[:, 0], minlength=num_locations), out=self.transfer_offsets[1:])
+        self.transfer_targets = transfers[:, 1]
+        self.transfer_times = transfers[:, 2]
+
+        self.footpaths = {}
+
+
+    def get_footpaths(self, loc_id):
+
+        footpaths = self.footpaths.get(loc_id)
+
+        if footpaths is None:
+            first, last = self.transfer_offsets[loc_id], self.transfer_offsets[loc_id + 1]
+            footpaths = list(zip(self.transfer_targets[first:last].tolist(), self.transfer_times[first:last].tolist()))
+            self.footpaths[loc_id] = footpaths
+
+        return footpaths
+
+
+    def scan(self, from_loc_id, dep_timestamp, to_loc_id=None, excluded_trips=()):
+
+        # Scans the connections departing after dep_timestamp. Returns the earliest
+        # arrival per location and the connection it was reached with, the earliest
+        # boarding time per location and the connection that enabled it, and the
+        # first boarded connection per trip. With to_loc_id the scan stops as soon
+        # as no later connection can arrive there earlier. Trips in excluded_trips
+        # are not boarded.
+
+        excluded_trips = frozenset(excluded_trips)
+
+        ready = {from_loc_id: dep_timestamp}
+        ready_connections = {}
+        arrivals = {}
+        arrival_connections = {}
+        boarded = {}
+
+        best = np.inf
+        get_footpaths = self.get_footpaths
+
+        first = int(np.searchsorted(self.dep_timestamps, dep_timestamp, side='right'))
+
+        for chunk in range(first, len(self.dep_timestamps), self.scan_chunk_size):
+
+            chunk_end = chunk + self.scan_chunk_size
+
+            dep_timestamps = self.dep_timestamps[chunk:chunk_end].tolist()
+
+            if to_loc_id is not None and dep_timestamps[0] >= best:
+                break
+
+            rows = zip(range(chunk, chunk_end), dep_timestamps, self.arr_timestamps[chunk:chunk_end].tolist(),
+                self.dep_locs[chunk:chunk_end].tolist(), self.arr_locs[chunk:chunk_end].tolist(),
+                self.trips[chunk:chunk_end].tolist())
+
+            for c, dep_time, arr_time, dep_loc, arr_loc, trip in rows:
+
+                if dep_time >= best:
+                    break
+
+                if trip not in boarded:
+                    if ready.get(dep_loc, np.inf) >= dep_time or trip in excluded_trips:
+                        continue
+                    boarded[trip] = c
+
+                if arr_time < arrivals.get(arr_loc, np.inf):
+
+                    arrivals[arr_loc] = arr_time
+                    arrival_connections[arr_loc] = c
+
+                    if arr_loc == to_loc_id:
+                        best = arr_time
+
+                    for target, transfer_time in get_footpaths(arr_loc):
+                        if arr_time + transfer_time < ready.get(target, np.inf):
+                            ready[target] = arr_time + transfer_time
+                            ready_connections[target] = c
+
+        return arrivals, arrival_connections, ready_connections, boarded
+
+
+    def earliest_arrival(self, from_loc_id, to_loc_id, dep_timestamp, excluded_trips=()):
+
+        # Earliest arrival at to_loc_id and the legs of the journey, each leg
+        # a list of connections (numbered as given to the constructor) of one trip
+
+        arrivals, arrival_connections, ready_connections, boarded = self.scan(from_loc_id, dep_timestamp, to_loc_id,
+            excluded_trips)
+
+        if to_loc_id not in arrivals:
+            return None, []
+
+        legs = self.get_legs(arrival_connections[to_loc_id], from_loc_id, ready_connections, boarded)
+
+        return arrivals[to_loc_id], legs
+
+
+    def earliest_arrivals(self, from_loc_id, dep_timestamp):
+
+        # Earliest arrival at every location from one scan without a target,
+        # np.inf where no connection gets there
+
+        arrivals, _, _, _ = self.scan(from_loc_id, dep_timestamp)
+
+        result = np.full(self.num_locations, np.inf)
+        result[list(arrivals.keys())] = list(arrivals.values())
+        result[from_loc_id] = dep_timestamp
+
+        return result
+
+
+    def get_legs(self, last_connection, from_loc_id, ready_connections, boarded):
+
+        legs = []
+
+        c = last_connection
+
+        while True:
+
+            trip = self.trips[c]
+            first = self.trip_positions[boarded[trip]]
+            last = self.trip_positions[c]
+
+            legs.append(self.order[self.trip_connections[first:last + 1]])
+
+            dep_loc = self.dep_locs[boarded[trip]]
+
+            if dep_loc == from_loc_id:
+                break
+
+            c = ready_connections[dep_loc]
+
+        return legs[::-1]
@@ -1,12 +1,144 @@
 import datetime as dt
 from time import sleep
+import time
 import json
+import queue
+import logging
+import random
+import sqlite3
+import itertools
+import threading
 import requests
+import requests.adapters
 import urllib.parse
 from timetable import timetable
+from trip_file import trip_file, is_trip_file
+
+class response_cache():
+
+    # Responses stored by URL in a SQLite file, shared between runs. Entries older
+    # than expiry seconds are requested again.
+
+    def __init__(self, filename, expiry):
+
+        self.expiry = expiry
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body TEXT, fetched REAL)')
+        self.connection.commit()
+
+
+    def get(self, url):
+
+        with self.lock:
+            row = self.connection.execute('SELECT body, fetched FROM responses WHERE url = ?', (url,)).fetchone()
+
+        if row is None or row[1] < time.time() - self.expiry:
+            return None
+
+        return json.loads(row[0])
+
+
+    def put(self, url, data):
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (url, json.dumps(data), time.time()))
+            self.connection.commit()
+
+
+class crawl_journal():
+
+    # Append-only file of the finished work of a crawl, one JSON record per line.
+    # A journey record holds a trip added to the trips, a board record a
+    # departure board page whose journeys have all been added.
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = None
+
+
+    def read(self):
+
+        # Records written so far. A crawl killed while writing may leave an
+        # incomplete line, which is skipped.
+
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            return
+
+
+    def write(self, record):
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filename, 'a')
+
+                # Records are not appended to an incomplete last line
+                if self.file.tell() > 0:
+                    with open(self.filename, 'rb') as f:
+                        f.seek(-1, 2)
+                        if f.read(1) != b'\n':
+                            self.file.write('\n')
+
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+
+    def close(self):
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class rate_limiter():
+
+    # Token bucket allowing requests_per_minute requests on average and bursts
+    # of up to burst requests
+
+    def __init__(self, requests_per_minute, burst=1):
+
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+
+        # Waits until a request may be sent
+
+        while True:
+
+            with self.lock:
+
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            sleep(wait_time)
+
 
 class db_api_parser():
 
+    # API endpoints, may be set on an instance to crawl another server
     url_stations = "https://api.deutschebahn.com/stada/v2/stations"
     url_departures = "https://api.deutschebahn.com/fahrplan-plus/v1/departureBoard/"
     url_journey_details = "https://api.deutschebahn.com/fahrplan-plus/v1/journeyDetails/"
@@ -14,19 +146,61 @@ class db_api_parser():
     max_wait_time = 1
     time_increment = 240
 
-    def __init__(self, api_key):
+    # Number of requests a crawl runs at the same time
+    max_workers = 8
+
+    # Failed requests (timeouts, connection errors, 429 and 5xx responses) are
+    # retried up to max_retries times, waiting a random time of up to
+    # retry_wait_time * 2^retry seconds, or as long as a 429 response asks
+    max_retries = 4
+    retry_wait_time = 1
+
+    # Journey details are requested before further departure boards
+    priority_journey_details = 0
+    priority_departures = 1
+
+    def __init__(self, api_key, max_workers=None, cache_file=None, cache_expiry=24*60*60, requests_per_minute=None,
+        rate_burst=1):
         self.api_key = api_key
 
+        if max_workers is not None:
+            self.max_workers = max_workers
+
+        # Optional limit of the API requests per minute, shared by all workers, with
+        # up to rate_burst requests sent at once
+        self.rate_limiter = None if requests_per_minute is None else rate_limiter(requests_per_minute, rate_burst)
+
+        # Optional on-disk cache of departure boards and journey details
+        self.cache = None if cache_file is None else response_cache(cache_file, cache_expiry)
+
         self.departure_request_times = []
         self.trip_request_times = []
 
-    def get_timetable(self, start, end, stop_categories = '1-7'):
-
         self.header = self.get_header()
+        self.session = None
+
+        # Guards the counters and the trips of a crawl
+        self.lock = threading.Lock()
+
+        self.reset_counters()
+
+        # Journey stops by journey key, and the keys of journeys added to trips
+        self.journeys = {}
+        self.resolved_journeys = set()
+
+        # Journal of the running crawl, and the next page of each departure board
+        # page finished by an earlier run, by eva number and page time
+        self.journal = None
+        self.finished_boards = {}
+
+        # Trip file the running crawl writes its trips to instead of the trips dict
+        self.trip_output = None
+
+    def get_timetable(self, start, end, stop_categories = '1-7', journal_file=None, trips_file=None):
 
         eva_numbers = self.get_eva_numbers(stop_categories)
 
-        trips = self.get_trips(start, end, eva_numbers)
+        trips = self.get_trips(start, end, eva_numbers, journal_file, trips_file)
 
         return timetable(start, end, trips)
 
@@ -36,11 +210,30 @@ class db_api_parser():
         return { "Accept": "application/json", "Authorization": "Bearer " + self.api_key }
 
 
+    def get_session(self):
+
+        # One session for all requests, keeping up to max_workers connections alive
+
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+        return self.session
+
+
+    def count(self, counter):
+
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
     def get_eva_numbers(self, categories):
 
         data = {'category': categories}
 
-        response = requests.get(self.url_stations, data, headers=self.header)
+        response = self.get_session().get(self.url_stations, params=data, headers=self.header)
 
         eva_numbers = []
 
@@ -51,30 +244,83 @@ class db_api_parser():
         return eva_numbers
 
 
-    def get_departures(self, eva_number, datetime):
+    def request(self, url, params, counter):
 
-        url = self.url_departures + str(eva_number)
-        data = {'date': datetime.isoformat()}
+        # JSON data of a GET request, from the response cache if possible. Requests,
+        # timeouts and failures are counted as counter, counter_timeout and
+        # counter_failed, where failures are requests which failed on every retry.
+        # Returns None if the request failed.
 
-        try:
-            self.count_dep_requests += 1
-            response = requests.get(url, data, headers=self.header, timeout=self.max_wait_time)
-        except (requests.Timeout):
-            self.count_dep_requests_timeout += 1
+        cache_key = url if not params else url + '?' + urllib.parse.urlencode(params)
+
+        if self.cache is not None:
+            data = self.cache.get(cache_key)
+            if data is not None:
+                self.count('count_cache_hits')
+                return data
+
+        for retry in range(self.max_retries + 1):
+
+            if retry > 0:
+                self.count('count_retries')
+                sleep(wait_time)
+
+            wait_time = random.uniform(0, self.retry_wait_time * 2**retry)
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                self.count(counter)
+                response = self.get_session().get(url, params=params, headers=self.header, timeout=self.max_wait_time)
+            except (requests.Timeout):
+                self.count(counter + '_timeout')
+                continue
+            except (requests.ConnectionError):
+                self.count('count_connection_errors')
+                continue
+
+            if response.status_code == 429:
+                self.count('count_rate_limited')
+                retry_after = response.headers.get('Retry-After', '')
+                wait_time = float(retry_after) if retry_after.isdigit() else wait_time
+                continue
+
+            if response.status_code >= 500:
+                self.count('count_server_errors')
+                continue
+
+            break
+
+        else:
+            self.count(counter + '_failed')
             return
-        except (requests.ConnectionError):
-            self.count_dep_requests_failed += 1
+
+        if response.status_code != 200:
+            self.count(counter + '_failed')
             return
 
-        #self.departure_request_times.append(response.elapsed.total_seconds())
+        data = response.json()
 
-        if response.status_code is not 200:
-            self.count_dep_requests_failed += 1
+        if self.cache is not None:
+            self.cache.put(cache_key, data)
+
+        return data
+
+
+    def get_departures(self, eva_number, datetime):
+
+        url = self.url_departures + str(eva_number)
+        data = {'date': datetime.isoformat()}
+
+        response = self.request(url, data, 'count_dep_requests')
+
+        if response is None:
             return
 
         departures = []
 
-        for departure in response.json():
+        for departure in response:
 
             dep_time = dt.datetime.strptime(departure['dateTime'], "%Y-%m-%dT%H:%M")
             
@@ -83,27 +329,67 @@ class db_api_parser():
         return departures
 
 
+    def journey_key(self, departure):
+
+        # A journey is known by its detailsId. The line name of a departure is
+        # shared by many journeys of a day and does not identify one.
+
+        return departure['details_id']
+
+
+    def get_journey_stops(self, departure):
+
+        # Stops of the journey of a departure, requested once per crawl. A departure
+        # of a journey that is being requested waits for its stops.
+
+        with self.lock:
+
+            journey = self.journeys.get(self.journey_key(departure))
+
+            is_new = journey is None
+
+            if is_new:
+                journey = {'done': threading.Event(), 'stops': None}
+                self.journeys[self.journey_key(departure)] = journey
+
+        if is_new:
+            try:
+                journey['stops'] = self.request(self.url_journey_details + urllib.parse.quote(departure['details_id']),
+                    None, 'count_trip_requests')
+            finally:
+                journey['done'].set()
+
+            # Failed requests are tried again by the next departure of the journey
+            if journey['stops'] is None:
+                with self.lock:
+                    if self.journeys.get(self.journey_key(departure)) is journey:
+                        del self.journeys[self.journey_key(departure)]
+        else:
+            self.count('count_trip_requests_saved')
+            journey['done'].wait()
+
+        return journey['stops']
+
+
+    def is_resolved(self, departure):
+
+        with self.lock:
+            return self.journey_key(departure) in self.resolved_journeys
+
+
     def get_journey_details(self, departure):
 
-        url = self.url_journey_details + urllib.parse.quote(departure['details_id'])
+        stops = self.get_journey_stops(departure)
 
-        try:
-            self.count_trip_requests += 1
-            response = requests.get(url, headers=self.header, timeout=self.max_wait_time)
-        except (requests.Timeout):
-            self.count_trip_requests_timeout += 1
-            return
-        except (requests.ConnectionError):
-            self.count_trip_requests_failed += 1
+        if stops is None:
             return
 
-        #self.trip_request_times.append(response.elapsed.total_seconds())
+        return self.parse_journey_details(departure, stops)
 
-        if response.status_code is not 200:
-            self.count_trip_requests_failed += 1
-            return
 
-        stops = response.json()
+    def parse_journey_details(self, departure, stops):
+
+        # Trip of the journey if the departure is at its first stop, otherwise None
 
         if stops[0]['stopId'] == departure['loc_id']:
 
@@ -139,9 +425,7 @@ class db_api_parser():
             return trip
 
 
-    def get_trips(self, start, end, eva_numbers):
-
-        trips = {}
+    def reset_counters(self):
 
         self.count_dep_requests = 0
         self.count_dep_requests_timeout = 0
@@ -149,41 +433,54 @@ class db_api_parser():
         self.count_trip_requests = 0
         self.count_trip_requests_timeout = 0
         self.count_trip_requests_failed = 0
+        self.count_trip_requests_saved = 0
+        self.count_cache_hits = 0
+        self.count_retries = 0
+        self.count_rate_limited = 0
+        self.count_server_errors = 0
+        self.count_connection_errors = 0
         self.count_evas_complete = 0
+        self.count_boards_resumed = 0
+        self.count_task_errors = 0
 
-        for eva_number in eva_numbers:
 
-            current_time = start
+    def get_trips(self, start, end, eva_numbers, journal_file=None, trips_file=None):
 
-            while current_time < end:
+        # With a journal file the crawl records its progress, and a crawl
+        # restarted with the same file skips the finished departure board pages
+        # and journeys. A crawl with a later end extends an earlier one.
+        # With a trips file (see trip_file) the trips are written to it as they
+        # are gathered, and a trip_file reading them is returned instead of a dict.
 
-                print('Gathering trips from {} at {}. Completed {} of {} stops. Gathered {} trips.'.format(
-                    eva_number, current_time, self.count_evas_complete, len(eva_numbers), len(trips)), end='\r')
+        trips = {}
 
-                departures = self.get_departures(eva_number, current_time)
+        self.reset_counters()
 
-                if departures is None:
-                    current_time += dt.timedelta(minutes=self.time_increment)
-                    continue
+        self.journeys = {}
+        self.resolved_journeys = set()
+        self.finished_boards = {}
 
-                for departure in departures:
-                    
-                    trip_id = departure['trip_id']
+        if trips_file is not None:
+            self.trip_output = trip_file(trips_file)
+            self.trip_output.open()
 
-                    if trip_id not in trips:
-                        trips[trip_id] = []
-
-                    trip = self.get_journey_details(departure)
+        try:
+            if journal_file is not None:
+                self.journal = crawl_journal(journal_file)
+                self.resume(trips)
 
-                    if trip is not None:
-                        trips[trip_id].append(trip)
+            self.crawl(start, end, eva_numbers, trips)
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
 
-                if len(departures) > 0:
-                    current_time = departures[-1]['dep_time'] + dt.timedelta(minutes=1)
-                else:
-                    current_time = current_time + dt.timedelta(minutes=self.time_increment)
+            if self.trip_output is not None:
+                self.trip_output.close()
+                self.trip_output = None
 
-            self.count_evas_complete += 1
+        self.journeys = {}
+        self.finished_boards = {}
 
         print('\n')
         print('Departure board API:')
@@ -196,14 +493,238 @@ class db_api_parser():
         print('Requests: {}'.format(self.count_trip_requests))
         print('Timeout: {}'.format(self.count_trip_requests_timeout))
         print('Failed: {}'.format(self.count_trip_requests_failed))
+        print('Saved by deduplication: {}'.format(self.count_trip_requests_saved))
+
+        print('\n')
+        print('Retries: {}'.format(self.count_retries))
+        print('Rate limited (429): {}'.format(self.count_rate_limited))
+        print('Server errors (5xx): {}'.format(self.count_server_errors))
+        print('Connection errors: {}'.format(self.count_connection_errors))
+
+        if self.cache is not None:
+            print('\n')
+            print('Responses from cache: {}'.format(self.count_cache_hits))
+
+        if journal_file is not None:
+            print('\n')
+            print('Departure board pages resumed from journal: {}'.format(self.count_boards_resumed))
 
         print('\n')
         print('{} trips gathered'.format(len(trips)))
 
+        if self.count_task_errors > 0:
+            print('{} requests could not be processed'.format(self.count_task_errors))
+
+        if trips_file is not None:
+            return trip_file(trips_file)
+
         return trips
 
 
+    def resume(self, trips):
+
+        # Restores the trips, journeys and departure board pages of the journal
+
+        num_journeys = 0
+
+        for record in self.journal.read():
+
+            if 'journey' in record:
+                departure = dict(record['journey'], dep_time=dt.datetime.fromisoformat(record['journey']['dep_time']))
+
+                if not self.is_resolved(departure):
+                    self.resolved_journeys.add(self.journey_key(departure))
+                    self.add_trip(trips, departure['trip_id'], record['trip'])
+                    num_journeys += 1
+
+            elif 'board' in record:
+                board = record['board']
+
+                self.finished_boards[(board['eva_number'], board['time'])] = dt.datetime.fromisoformat(board['next_time'])
+
+                for trip_id in board['trip_ids']:
+                    trips.setdefault(trip_id, [])
+
+        print('Resumed {} journeys and {} departure board pages from {}'.format(
+            num_journeys, len(self.finished_boards), self.journal.filename))
+
+
+    def add_trip(self, trips, trip_name, trip):
+
+        # Adds a trip to the trips dict, or writes it to the trip file of the crawl
+
+        if self.trip_output is not None:
+            trips.setdefault(trip_name, [])
+            self.trip_output.write_trip(trip_name, trip)
+        else:
+            trips.setdefault(trip_name, []).append(trip)
+
+
+    def crawl(self, start, end, eva_numbers, trips):
+
+        # Runs the requests of a crawl on max_workers threads sharing one session.
+        # The departure boards of a station are requested one page after the other,
+        # each page queues the journey details of its departures. Tasks are taken
+        # by priority, then in the order they were queued.
+
+        tasks = queue.PriorityQueue()
+        self.task_numbers = itertools.count()
+
+        for eva_number in eva_numbers:
+            self.put_task(tasks, self.priority_departures, self.crawl_departures,
+                (eva_number, start, end, len(eva_numbers), tasks, trips))
+
+        workers = [threading.Thread(target=self.crawl_worker, args=(tasks,), daemon=True)
+            for i in range(self.max_workers)]
+
+        for worker in workers:
+            worker.start()
+
+        tasks.join()
+
+        for worker in workers:
+            self.put_task(tasks, float('inf'), None, None)
+
+        for worker in workers:
+            worker.join()
+
+
+    def crawl_worker(self, tasks):
+
+        while True:
+
+            _, _, function, args = tasks.get()
+
+            if function is None:
+                tasks.task_done()
+                return
+
+            # Network and JSON errors are counted, anything else is a bug and logged
+            # with its traceback
+
+            try:
+                function(*args)
+            except (requests.RequestException, ValueError):
+                self.count('count_task_errors')
+            except Exception:
+                logging.exception('Crawl task {} failed for {}'.format(function.__name__, args[0]))
+            finally:
+                tasks.task_done()
+
+
+    def put_task(self, tasks, priority, function, args):
+
+        tasks.put((priority, next(self.task_numbers), function, args))
+
+
+    def crawl_departures(self, eva_number, current_time, end, num_evas, tasks, trips):
+
+        if current_time >= end:
+            self.count('count_evas_complete')
+            return
+
+        next_time = self.finished_boards.get((eva_number, current_time.isoformat()))
+
+        if next_time is not None:
+            self.count('count_boards_resumed')
+            self.put_task(tasks, self.priority_departures, self.crawl_departures,
+                (eva_number, next_time, end, num_evas, tasks, trips))
+            return
+
+        print('Gathering trips from {} at {}. Completed {} of {} stops. Gathered {} trips.'.format(
+            eva_number, current_time, self.count_evas_complete, num_evas, len(trips)), end='\r')
+
+        departures = self.get_departures(eva_number, current_time)
+
+        if departures is None:
+            next_time = current_time + dt.timedelta(minutes=self.time_increment)
+
+        else:
+            if len(departures) > 0:
+                next_time = departures[-1]['dep_time'] + dt.timedelta(minutes=1)
+            else:
+                next_time = current_time + dt.timedelta(minutes=self.time_increment)
+
+            # The page is journaled once all of its journeys are done, pages with
+            # failed requests are requested again by a resumed crawl
+            page = {'eva_number': eva_number, 'time': current_time.isoformat(), 'next_time': next_time.isoformat(),
+                'trip_ids': [departure['trip_id'] for departure in departures], 'pending': 1, 'failed': False}
+
+            for departure in departures:
+
+                with self.lock:
+                    if departure['trip_id'] not in trips:
+                        trips[departure['trip_id']] = []
+
+                if self.is_resolved(departure):
+                    self.count('count_trip_requests_saved')
+                    continue
+
+                with self.lock:
+                    page['pending'] += 1
+
+                self.put_task(tasks, self.priority_journey_details, self.crawl_journey_details, (departure, trips, page))
+
+            self.finish_page(page, True)
+
+        self.put_task(tasks, self.priority_departures, self.crawl_departures,
+            (eva_number, next_time, end, num_evas, tasks, trips))
+
+
+    def crawl_journey_details(self, departure, trips, page=None):
+
+        succeeded = False
+
+        try:
+            stops = self.get_journey_stops(departure)
+
+            if stops is not None:
+                trip = self.parse_journey_details(departure, stops)
+
+                if trip is not None:
+                    with self.lock:
+                        if self.journey_key(departure) not in self.resolved_journeys:
+                            self.resolved_journeys.add(self.journey_key(departure))
+                            self.add_trip(trips, departure['trip_id'], trip)
+
+                            if self.journal is not None:
+                                self.journal.write({'journey': {'trip_id': departure['trip_id'], 'details_id': departure['details_id'],
+                                    'dep_time': departure['dep_time'].isoformat()}, 'trip': trip})
+
+                succeeded = True
+        finally:
+            if page is not None:
+                self.finish_page(page, succeeded)
+
+
+    def finish_page(self, page, succeeded):
+
+        with self.lock:
+            page['pending'] -= 1
+            page['failed'] = page['failed'] or not succeeded
+            finished = page['pending'] == 0 and not page['failed']
+
+        if finished and self.journal is not None:
+            self.journal.write({'board': {key: page[key] for key in ('eva_number', 'time', 'next_time', 'trip_ids')}})
+
+
     def save_trips_to_file(self, trips, filename):
 
+        # Trip files (.ndjson or .jsonl, optionally .gz or .zst) are written one
+        # trip per line, other files as one JSON object. trips is a trips dict or
+        # a trip_file as returned by get_trips.
+
+        if is_trip_file(filename):
+            trip_file(filename).write(trips)
+            return
+
+        if isinstance(trips, trip_file):
+            trip_lists = {}
+
+            for trip_name, trip_list in trips.items():
+                trip_lists.setdefault(trip_name, []).extend(trip_list)
+
+            trips = trip_lists
+
         with open(filename, 'w') as f:
             json.dump(trips, f)
@@ -1,5 +1,6 @@
 import partridge as ptg
 import pandas as pd
+import numpy as np
 import datetime as dt
 from shapely import wkt
 import timetable_graph as tg
@@ -9,26 +10,60 @@ class gtfs_parser():
     def __init__(self, gtfs_path):
         self.gtfs_path = gtfs_path
 
+        self.feed = None
+        self.service_ids_by_date = None
+
+
+    def load_feed(self):
+
+        # The feed and the service calendar are parsed once per session,
+        # all later views are filtered from the in-memory tables
+        if self.feed is None:
+            print('Loading GTFS feed from {}'.format(self.gtfs_path))
+            self.feed = ptg.load_geo_feed(self.gtfs_path)
+            self.service_ids_by_date = ptg.read_service_ids_by_date(self.gtfs_path)
+
+        return self.feed
+
+
+    def close_feed(self):
+
+        self.feed = None
+        self.service_ids_by_date = None
+
 
     def get_service_ids(self, date):
 
-        service_ids_by_date = ptg.read_service_ids_by_date(self.gtfs_path)
+        self.load_feed()
 
-        return service_ids_by_date[date]
+        return self.service_ids_by_date[date]
+
+
+    def get_timezone(self):
+
+        # Timezone of the feed's times, as used by GTFS-Realtime updates
+
+        return self.load_feed().agency['agency_timezone'].iloc[0]
 
 
     def get_busiest_date(self):
 
-        return ptg.read_busiest_date(self.gtfs_path)[0]
+        trip_counts = self.load_feed().trips['service_id'].value_counts()
+
+        trip_counts_by_date = {}
+
+        for date, service_ids in self.service_ids_by_date.items():
+            trip_counts_by_date[date] = trip_counts.reindex(list(service_ids), fill_value=0).sum()
+
+        # Earliest date with the most trips, as in ptg.read_busiest_date
+        return max(trip_counts_by_date.items(), key=lambda x: (x[1], -x[0].toordinal()))[0]
 
 
     def get_trips(self, service_ids):
 
-        view = {
-            'trips.txt': {'service_id': service_ids}
-        }
+        df = self.load_feed().trips
 
-        df = ptg.load_geo_feed(self.gtfs_path, view).trips
+        df = df[df['service_id'].isin(list(service_ids))]
 
         df = df.set_index('trip_id')
 
@@ -37,11 +72,9 @@ class gtfs_parser():
 
     def get_stop_times(self, trip_ids):
 
-        view = {
-            'stop_times.txt': {'trip_id': trip_ids}
-        }
+        df = self.load_feed().stop_times
 
-        df = ptg.load_geo_feed(self.gtfs_path, view).stop_times
+        df = df[df['trip_id'].isin(trip_ids)]
 
         df = df.set_index(['trip_id', 'stop_sequence'])
 
@@ -50,11 +83,9 @@ class gtfs_parser():
 
     def get_stops(self, stop_ids):
 
-        view = {
-            'stops.txt': {'stop_id': stop_ids}
-        }
+        df = self.load_feed().stops
 
-        df = ptg.load_geo_feed(self.gtfs_path, view).stops
+        df = df[df['stop_id'].isin(stop_ids)]
 
         df = df.set_index('stop_id')
 
@@ -63,11 +94,9 @@ class gtfs_parser():
 
     def get_transfers(self, stop_ids):
 
-        view = {
-            'transfers.txt': {'from_stop_id': stop_ids}
-        }
+        df = self.load_feed().transfers
 
-        df = ptg.load_geo_feed(self.gtfs_path, view).transfers
+        df = df[df['from_stop_id'].isin(stop_ids)]
 
         df = df.set_index(['from_stop_id', 'to_stop_id'])
 
@@ -98,52 +127,84 @@ class gtfs_parser():
         print('GTFS import complete')
 
 
-    def get_timetable_graph(self, min_transfer_time, max_transfer_time):
-        
+    def get_timetable_graph(self, min_transfer_time, max_transfer_time, waiting_chains=False):
+
         begin = dt.datetime.combine(self.date, dt.time(0, 0))
         end = dt.datetime.combine(self.date, dt.time(23, 59))
 
         print('Generating timetable graph')
-        timetable = tg.timetable_graph(begin, end)
+        timetable = tg.timetable_graph(begin, end, waiting_chains)
         
 
-        for index, row in self.stops.iterrows():
-            timetable.add_location(index, row['stop_name'], row['geometry'].coords[0][1],row['geometry'].coords[0][0])
+        timetable.add_locations(self.stops.index.values, self.stops['stop_name'].values,
+            self.stops['geometry'].y.values, self.stops['geometry'].x.values)
         print('Added {} locations'.format(len(self.stops)))
 
-        counter = 0
-        for trip_id, trip_df in self.stop_times.groupby(level=0):
+        stop_times = self.interpolate_stop_times(self.stop_times.sort_index())
 
-            trip_name = self.trips.loc[trip_id]['route_id']
+        trip_sizes = stop_times.groupby(level=0, sort=True).size()
+        trip_offsets = np.concatenate(([0], np.cumsum(trip_sizes.values)))
+        trip_ids = trip_sizes.index.values
+        trip_names = self.trips.loc[trip_ids, 'route_id'].values
 
-            loc_ids = []
-            arr_times = []
-            dep_times = []
+        # partridge parses GTFS times to seconds after midnight, the graph counts minutes
+        arr_times = stop_times['arrival_time']
+        dep_times = stop_times['departure_time']
 
-            loc_ids.append(trip_df.loc[trip_id, 1]['stop_id'])
-            dep_times.append(self.timedate_from_timestamp(trip_df.loc[trip_id, 1]['departure_time'], begin))
+        timetable.add_trips(trip_ids, trip_names, trip_offsets, stop_times['stop_id'].values,
+            (arr_times.values // 60).astype(int), (dep_times.values // 60).astype(int))
+        print('Added {} trips'.format(len(trip_ids)))
 
-            for i in range(2, len(trip_df)):
-                loc_ids.append(trip_df.loc[trip_id, i]['stop_id'])
-                arr_times.append(self.timedate_from_timestamp(trip_df.loc[trip_id, i]['arrival_time'], begin))
-                dep_times.append(self.timedate_from_timestamp(trip_df.loc[trip_id, i]['departure_time'], begin))
 
-            arr_times.append(self.timedate_from_timestamp(trip_df.loc[trip_id, len(trip_df)]['arrival_time'], begin))
+        num_transfer_edges = timetable.add_transfers(self.transfers.index.get_level_values(0),
+            self.transfers.index.get_level_values(1), min_transfer_time, max_transfer_time)
+        print('Added {} transfer options with {} transfer edges'.format(len(self.transfers), num_transfer_edges))
 
-            timetable.add_trip(loc_ids, dep_times, arr_times, trip_id, trip_name)
-            counter += 1
+        return timetable
 
-            if counter % 1000 == 0:
-                print('Added {} trips'.format(counter), end='\r')
 
-        print('Added {} trips'.format(counter))
+    def interpolate_stop_times(self, stop_times):
 
+        # Stop times sorted by trip and stop sequence with a missing arrival or
+        # departure time set to the other one. Stops without either time get the
+        # time interpolated by stop sequence between the previous departure and
+        # the next arrival of their trip, untimed stops before the first or after
+        # the last timed stop of a trip are dropped.
 
-        for transfer_id, transfer_type in self.transfers.iterrows():
-            timetable.add_transfer(transfer_id[0], transfer_id[1], min_transfer_time, max_transfer_time)
-        print('Added {} transfer options'.format(len(self.transfers)))
+        stop_times = stop_times.copy()
 
-        return timetable
+        arr_times = stop_times['arrival_time'].fillna(stop_times['departure_time'])
+        dep_times = stop_times['departure_time'].fillna(stop_times['arrival_time'])
+
+        is_untimed = arr_times.isna().values
+
+        if is_untimed.any():
+
+            trips = stop_times.index.get_level_values(0)
+            positions = pd.Series(np.where(is_untimed, np.nan, np.arange(len(stop_times))), index=stop_times.index)
+
+            prev_times = dep_times.groupby(trips).ffill()
+            next_times = arr_times.groupby(trips).bfill()
+            prev_positions = positions.groupby(trips).ffill()
+            next_positions = positions.groupby(trips).bfill()
+
+            times = prev_times + (next_times - prev_times) * (np.arange(len(stop_times)) - prev_positions) / (
+                next_positions - prev_positions)
+
+            arr_times = arr_times.where(~is_untimed, times)
+            dep_times = dep_times.where(~is_untimed, times)
+
+        stop_times['arrival_time'] = arr_times
+        stop_times['departure_time'] = dep_times
+
+        is_dropped = arr_times.isna().values
+
+        if is_dropped.any():
+            print('Dropped {} stop times without arrival or departure time before the first or after the last '
+                'timed stop of their trip'.format(is_dropped.sum()))
+            stop_times = stop_times[~is_dropped]
+
+        return stop_times
 
 
     def timedate_from_timestamp(self, timestamp, reference_datetime):
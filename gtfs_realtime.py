@@ -0,0 +1,102 @@
+import json
+import datetime as dt
+from zoneinfo import ZoneInfo
+
+def field(message, name):
+
+    # Field of a feed message in JSON form, which may use the proto field name or
+    # its lowerCamelCase version
+
+    camel_name = name.split('_')[0] + ''.join(part.title() for part in name.split('_')[1:])
+
+    return message.get(name, message.get(camel_name))
+
+
+def stop_time_event(stop_time_update, name):
+
+    # Delay in seconds and real-time datetime (in UTC) of the arrival or departure,
+    # None if not given
+
+    event = field(stop_time_update, name) or {}
+
+    delay = field(event, 'delay')
+    time = field(event, 'time')
+
+    return (None if delay is None else int(delay),
+        None if time is None or int(time) == 0 else dt.datetime.fromtimestamp(int(time), dt.timezone.utc))
+
+
+def local_datetime(datetime, timezone):
+
+    # Naive local datetime in timezone (a tzinfo or a name like 'Europe/Berlin',
+    # the agency_timezone of the feed) of a real-time datetime
+
+    if isinstance(timezone, str):
+        timezone = ZoneInfo(timezone)
+
+    return datetime.astimezone(timezone).replace(tzinfo=None)
+
+
+def read_trip_updates(filename):
+
+    # Trip updates of a GTFS-Realtime feed, read from the protobuf file or its JSON
+    # form (.json). Each update is a dict of trip_id, canceled and stop_time_updates,
+    # a list of dicts with stop_id, arrival_delay, departure_delay (in seconds),
+    # arrival_time and departure_time (UTC datetimes, see local_datetime), None
+    # where not given.
+    # Skipped stops and updates without a stop id are left out.
+
+    if filename.endswith('.json'):
+        with open(filename) as f:
+            feed = json.load(f)
+    else:
+        # Only needed for protobuf feeds, from the gtfs-realtime-bindings package
+        from google.transit import gtfs_realtime_pb2
+        from google.protobuf import json_format
+
+        message = gtfs_realtime_pb2.FeedMessage()
+
+        with open(filename, 'rb') as f:
+            message.ParseFromString(f.read())
+
+        feed = json_format.MessageToDict(message, preserving_proto_field_name=True)
+
+    trip_updates = []
+
+    for entity in feed.get('entity', []):
+
+        trip_update = field(entity, 'trip_update')
+
+        if trip_update is None or field(entity, 'is_deleted'):
+            continue
+
+        trip = field(trip_update, 'trip') or {}
+
+        if field(trip, 'trip_id') is None:
+            continue
+
+        stop_time_updates = []
+
+        for stop_time_update in field(trip_update, 'stop_time_update') or []:
+
+            if field(stop_time_update, 'stop_id') is None or field(stop_time_update, 'schedule_relationship') == 'SKIPPED':
+                continue
+
+            arrival_delay, arrival_time = stop_time_event(stop_time_update, 'arrival')
+            departure_delay, departure_time = stop_time_event(stop_time_update, 'departure')
+
+            stop_time_updates.append({
+                'stop_id': field(stop_time_update, 'stop_id'),
+                'arrival_delay': arrival_delay,
+                'departure_delay': departure_delay,
+                'arrival_time': arrival_time,
+                'departure_time': departure_time
+                })
+
+        trip_updates.append({
+            'trip_id': field(trip, 'trip_id'),
+            'canceled': field(trip, 'schedule_relationship') in ('CANCELED', 'DELETED'),
+            'stop_time_updates': stop_time_updates
+            })
+
+    return trip_updates
@@ -0,0 +1,139 @@
+import re
+import unicodedata
+import numpy as np
+
+def normalize_name(name):
+
+    # Lower case ASCII words separated by single spaces
+
+    name = unicodedata.normalize('NFKD', str(name).lower().replace('ß', 'ss'))
+    name = name.encode('ascii', 'ignore').decode('ascii')
+
+    return ' '.join(re.sub('[^a-z0-9]+', ' ', name).split())
+
+
+def trigrams(normalized_name):
+
+    padded = '  ' + normalized_name + ' '
+
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class name_index:
+
+    # Trigram index over location names. Matches are ranked by the trigram
+    # similarity to the search string, names starting with it or with a word
+    # starting with it rank first. Other names only match if they contain at
+    # least min_match of the trigrams of the search string. Apart from names and
+    # loc_ids the index is held in arrays, so that it is saved and memory mapped
+    # with the graph.
+
+    min_match = 0.5
+
+    # Characters of the name endings kept for prefix lookups, longer search
+    # strings are checked against the names
+    word_start_length = 24
+
+    def __init__(self, names, loc_ids):
+
+        self.names = list(names)
+        self.loc_ids = list(loc_ids)
+        normalized_names = [normalize_name(name) for name in self.names]
+
+        # Names containing each trigram, CSR style: the names of trigram_keys[i]
+        # are at posting_offsets[i]:posting_offsets[i+1] of posting_names
+        postings = sorted((trigram, i) for i, normalized_name in enumerate(normalized_names)
+            for trigram in trigrams(normalized_name))
+
+        self.trigram_keys, offsets = np.unique(np.array([trigram for trigram, i in postings], dtype='U3'),
+            return_index=True)
+        self.posting_offsets = np.append(offsets, len(postings)).astype(np.int64)
+        self.posting_names = np.array([i for trigram, i in postings], dtype=np.int64)
+
+        # Name endings starting at each word, sorted for prefix lookups
+        word_starts = sorted((normalized_name[m.start():][:self.word_start_length], i)
+            for i, normalized_name in enumerate(normalized_names) for m in re.finditer('[a-z0-9]+', normalized_name))
+
+        self.word_starts = np.array([word_start.encode('ascii') for word_start, i in word_starts],
+            dtype='S{}'.format(self.word_start_length))
+        self.word_start_names = np.array([i for word_start, i in word_starts], dtype=np.int64)
+
+        self.num_trigrams = np.array([len(trigrams(normalized_name)) for normalized_name in normalized_names],
+            dtype=np.int64)
+
+
+    def prefix_matches(self, query):
+
+        # Names starting with query or with a word starting with query
+
+        prefix = query[:self.word_start_length].encode('ascii')
+
+        first = np.searchsorted(self.word_starts, prefix, 'left')
+
+        if len(prefix) < self.word_start_length:
+            last = np.searchsorted(self.word_starts, prefix + b'~', 'left')
+        else:
+            last = np.searchsorted(self.word_starts, prefix, 'right')
+
+        matches = self.word_start_names[first:last]
+
+        if len(query) > self.word_start_length:
+            matches = np.array([i for i in matches.tolist() if (' ' + normalize_name(self.names[i])).find(' ' + query) >= 0],
+                dtype=np.int64)
+
+        return matches
+
+
+    def search(self, search_str, k=10):
+
+        # Top k matches as (name, loc_id)
+
+        query = normalize_name(search_str)
+
+        if query == '':
+            return []
+
+        query_trigrams = np.array(sorted(trigrams(query)), dtype='U3')
+
+        positions = np.minimum(np.searchsorted(self.trigram_keys, query_trigrams), max(len(self.trigram_keys) - 1, 0))
+        positions = positions[self.trigram_keys[positions] == query_trigrams] if len(self.trigram_keys) > 0 else positions[:0]
+
+        if len(positions) == 0:
+            return []
+
+        matches = np.concatenate([self.posting_names[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+            for i in positions.tolist()])
+
+        # Counting by sort is faster for rare trigrams, bincount for common ones
+        if len(matches) < len(self.names) // 16:
+            matches.sort()
+            starts = np.flatnonzero(np.diff(matches, prepend=-1))
+            candidates = matches[starts]
+            common = np.diff(starts, append=len(matches))
+        else:
+            common = np.bincount(matches, minlength=len(self.names))
+            candidates = np.flatnonzero(common)
+            common = common[candidates]
+
+        is_prefix = np.zeros(len(self.names), dtype=bool)
+        is_prefix[self.prefix_matches(query)] = True
+
+        # Names sharing only a few common trigrams like ' b' or 'in ' are no matches
+        is_match = is_prefix[candidates] | (common >= self.min_match * len(query_trigrams))
+        candidates, common = candidates[is_match], common[is_match]
+
+        if len(candidates) == 0:
+            return []
+
+        scores = 2 * common / (len(query_trigrams) + self.num_trigrams[candidates])
+
+        # Prefix matches first, then by similarity, then shorter names first
+        ranks = is_prefix[candidates] + scores
+
+        if len(candidates) > k:
+            top = np.argpartition(-ranks, k - 1)[:k]
+            candidates, ranks = candidates[top], ranks[top]
+
+        best = np.lexsort((self.num_trigrams[candidates], -ranks))
+
+        return [(self.names[i], self.loc_ids[i]) for i in candidates[best].tolist()]
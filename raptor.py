@@ -0,0 +1,287 @@
+import numpy as np
+
+class raptor:
+
+    # Round-based public transit routing (RAPTOR). Trips with the same stop
+    # sequence form a route, round k finds the earliest arrivals with k trips.
+    # Transfers are footpaths between locations, a trip can be boarded at a
+    # location once the arrival there plus the transfer time lies before its
+    # departure.
+
+    def __init__(self, trip_offsets, loc_ids, arr_timestamps, dep_timestamps, transfers, num_locations):
+
+        # The stop events of trip k are at trip_offsets[k]:trip_offsets[k+1],
+        # transfers are rows of (from_loc, to_loc, transfer_time)
+
+        self.num_locations = num_locations
+
+        self.trip_offsets = np.asarray(trip_offsets, dtype=np.int64)
+        loc_ids = np.asarray(loc_ids, dtype=np.int64)
+        arr_timestamps = np.asarray(arr_timestamps, dtype=np.int64)
+        dep_timestamps = np.asarray(dep_timestamps, dtype=np.int64)
+        self.dep_timestamps = dep_timestamps
+
+        patterns = {}
+
+        for trip, (first, last) in enumerate(zip(self.trip_offsets[:-1].tolist(), self.trip_offsets[1:].tolist())):
+            if last - first > 1:
+                patterns.setdefault(tuple(loc_ids[first:last].tolist()), []).append(trip)
+
+        self.route_stops = []
+        self.route_trips = []
+        self.route_arr_timestamps = []
+        self.route_dep_timestamps = []
+
+        for stops, trips in patterns.items():
+
+            first = self.trip_offsets[trips]
+            events = first[:, None] + np.arange(len(stops))
+
+            arr = arr_timestamps[events]
+            dep = dep_timestamps[events]
+
+            order = np.argsort(dep[:, 0], kind='stable')
+
+            # Trips of a route must not overtake each other, otherwise split the route
+            routes = []
+
+            for i in order:
+                for route in routes:
+                    j = route[-1]
+                    if (arr[i] >= arr[j]).all() and (dep[i] >= dep[j]).all():
+                        route.append(i)
+                        break
+                else:
+                    routes.append([i])
+
+            for route in routes:
+                self.route_stops.append(list(stops))
+                self.route_trips.append(np.asarray(trips)[route])
+                self.route_arr_timestamps.append(arr[route])
+                self.route_dep_timestamps.append(dep[route])
+
+        self.stop_routes = [[] for i in range(num_locations)]
+
+        for route, stops in enumerate(self.route_stops):
+            for position, stop in enumerate(stops):
+                self.stop_routes[stop].append((route, position))
+
+        transfers = np.asarray(transfers, dtype=np.int64).reshape(-1, 3)
+
+        self.footpaths = [[] for i in range(num_locations)]
+
+        for from_loc, to_loc, transfer_time in transfers.tolist():
+            self.footpaths[from_loc].append((to_loc, transfer_time))
+
+
+    def pareto_journeys(self, from_loc_id, to_loc_id, dep_timestamp, max_rounds):
+
+        # Journeys that are Pareto optimal in arrival time and number of trips, with
+        # fewest trips first. Each journey is (arrival, legs), a leg is given as
+        # (trip, board position, alight position) in the stop events of the trip.
+
+        labels = self.new_labels(max_rounds)
+
+        return self.run_rounds(from_loc_id, to_loc_id, dep_timestamp, labels)
+
+
+    def range_journeys(self, from_loc_id, to_loc_id, first_dep_timestamp, last_dep_timestamp, max_rounds):
+
+        # Journeys departing in the window that are Pareto optimal in departure
+        # time, arrival time and number of trips, ordered by departure (rRAPTOR).
+        # Rounds are run once per departure at from_loc_id, latest first, and
+        # keep their labels: an earlier departure only has to improve on them.
+        # Each journey is (departure, arrival, legs).
+
+        labels = self.new_labels(max_rounds, last_dep_timestamp)
+
+        candidates = {}
+
+        for dep_time in self.departure_times(from_loc_id, first_dep_timestamp, last_dep_timestamp)[::-1]:
+            for arr_time, legs in self.run_rounds(from_loc_id, to_loc_id, dep_time - 1, labels):
+                trip, board_position, _ = legs[0]
+                board_time = int(self.dep_timestamps[self.trip_offsets[trip] + board_position])
+                candidates.setdefault((board_time, arr_time, len(legs)), legs)
+
+        # A run can find a journey that boards a later departure, keep the non-dominated ones
+        journeys = []
+
+        for (dep_time, arr_time, num_legs), legs in sorted(candidates.items()):
+            if not any(other[0] >= dep_time and other[1] <= arr_time and other[2] <= num_legs
+                and other != (dep_time, arr_time, num_legs) for other in candidates):
+                journeys.append((dep_time, arr_time, legs))
+
+        return journeys
+
+
+    def departure_times(self, loc_id, first_timestamp, last_timestamp):
+
+        # Distinct departure times of all routes at loc_id within the window
+
+        dep_times = [self.route_dep_timestamps[route][:, position]
+            for route, position in self.stop_routes[loc_id] if position < len(self.route_stops[route]) - 1]
+
+        if len(dep_times) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        dep_times = np.unique(np.concatenate(dep_times))
+
+        return dep_times[(dep_times >= first_timestamp) & (dep_times <= last_timestamp)]
+
+
+    def new_labels(self, max_rounds, last_dep_timestamp=np.inf):
+
+        # Arrivals and boarding times per round, kept with the best value for at
+        # most k trips per location. Trips departing from the origin after
+        # last_dep_timestamp are not boarded.
+
+        return {
+            'max_rounds': max_rounds,
+            'last_departure': last_dep_timestamp,
+            'arrivals': [{} for k in range(max_rounds + 1)],
+            'ready': [{} for k in range(max_rounds + 1)],
+            'best_arrivals': {},
+            'best_ready': {}
+            }
+
+
+    def run_rounds(self, from_loc_id, to_loc_id, dep_timestamp, labels):
+
+        max_rounds = labels['max_rounds']
+
+        arrival_rounds = labels['arrivals']
+        ready_rounds = labels['ready']
+        best_ready = labels['best_ready']
+
+        self.set_label(best_ready, from_loc_id, 0, (dep_timestamp, 0), max_rounds)
+        ready_rounds[0][from_loc_id] = (dep_timestamp, None)
+
+        marked = {from_loc_id}
+
+        journeys = []
+
+        for k in range(1, max_rounds + 1):
+
+            queue = {}
+
+            for stop in marked:
+                for route, position in self.stop_routes[stop]:
+                    if position < queue.get(route, len(self.route_stops[route])):
+                        queue[route] = position
+
+            arrivals = {}
+
+            for route, start in queue.items():
+                self.scan_route(route, start, k, labels, arrivals, to_loc_id)
+
+            arrival_rounds[k].update(arrivals)
+
+            ready = {}
+
+            for stop, (arr_time, parent) in arrivals.items():
+                for target, transfer_time in self.footpaths[stop]:
+                    if self.set_label(best_ready, target, k, (arr_time + transfer_time, k), max_rounds):
+                        ready[target] = (arr_time + transfer_time, stop)
+
+            ready_rounds[k].update(ready)
+
+            if to_loc_id in arrivals:
+                journeys.append((arrivals[to_loc_id][0], self.get_legs(to_loc_id, k, arrival_rounds, ready_rounds)))
+
+            marked = set(ready)
+
+            if len(marked) == 0:
+                break
+
+        return journeys
+
+
+    def set_label(self, best, stop, k, label, max_rounds):
+
+        # Sets the label for k or more trips where it improves, best[stop][k] is the
+        # best label using at most k trips
+
+        labels = best.get(stop)
+
+        if labels is None:
+            labels = [None] * (max_rounds + 1)
+            best[stop] = labels
+
+        if labels[k] is not None and labels[k][0] <= label[0]:
+            return False
+
+        for i in range(k, max_rounds + 1):
+            if labels[i] is not None and labels[i][0] <= label[0]:
+                break
+            labels[i] = label
+
+        return True
+
+
+    def scan_route(self, route, start, k, labels, arrivals, to_loc_id):
+
+        max_rounds = labels['max_rounds']
+        best_arrivals = labels['best_arrivals']
+        best_ready = labels['best_ready']
+
+        stops = self.route_stops[route]
+        dep_timestamps = self.route_dep_timestamps[route]
+
+        target_labels = best_arrivals.get(to_loc_id)
+        target_arrival = np.inf if target_labels is None or target_labels[k] is None else target_labels[k][0]
+
+        trip = None
+
+        for position in range(start, len(stops)):
+
+            stop = stops[position]
+
+            if trip is not None:
+
+                arr_time = trip_arrivals[position]
+
+                if arr_time < target_arrival and self.set_label(best_arrivals, stop, k, (arr_time,), max_rounds):
+                    arrivals[stop] = (arr_time, (route, trip, board_position, position, ready_round))
+
+                    if stop == to_loc_id:
+                        target_arrival = arr_time
+
+            ready_labels = best_ready.get(stop)
+
+            if ready_labels is None or ready_labels[k - 1] is None:
+                continue
+
+            ready_time, label_round = ready_labels[k - 1]
+
+            if trip is not None and ready_time >= trip_departures[position]:
+                continue
+
+            earlier = np.searchsorted(dep_timestamps[:, position], ready_time, side='right')
+
+            if label_round == 0 and earlier < len(dep_timestamps) and dep_timestamps[earlier, position] > labels['last_departure']:
+                continue
+
+            if earlier < len(dep_timestamps) and (trip is None or earlier < trip):
+                trip = earlier
+                trip_arrivals = self.route_arr_timestamps[route][trip].tolist()
+                trip_departures = dep_timestamps[trip].tolist()
+                board_position = position
+                ready_round = label_round
+
+
+    def get_legs(self, stop, k, arrival_rounds, ready_rounds):
+
+        legs = []
+
+        while k > 0:
+
+            route, trip, board_position, alight_position, ready_round = arrival_rounds[k][stop][1]
+
+            legs.append((self.route_trips[route][trip], board_position, alight_position))
+
+            board_stop = self.route_stops[route][board_position]
+
+            k = ready_round
+            stop = ready_rounds[k][board_stop][1]
+
+        return legs[::-1]
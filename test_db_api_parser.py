@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+import datetime as dt
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from db_api_parser import db_api_parser
+
+class db_api_stub():
+
+    # Local server for the departureBoard and journeyDetails endpoints, serving
+    # journeys given as (details id, line name, [(eva number, arrival, departure)])
+    # with times as 'HH:MM' on date. Departure boards hold up to page_size
+    # departures from the requested time on. The next requests are answered from
+    # failures first, as (status, delay in seconds), with status None to answer
+    # normally after the delay.
+
+    page_size = 3
+
+    def __init__(self, journeys, date):
+
+        self.journeys = {}
+        self.departures = {}
+        self.num_requests = 0
+        self.request_times = []
+        self.failures = []
+        self.lock = threading.Lock()
+
+        for details_id, name, stops in journeys:
+
+            self.journeys[details_id] = []
+
+            for eva_number, arr_time, dep_time in stops:
+
+                stop = {'stopId': eva_number, 'stopName': 'Station {}'.format(eva_number),
+                    'lat': 50 + eva_number % 100 / 100, 'lon': 8 + eva_number % 7 / 10,
+                    'train': name, 'type': name.split()[0]}
+
+                if arr_time is not None:
+                    stop['arrTime'] = arr_time
+
+                if dep_time is not None:
+                    stop['depTime'] = dep_time
+
+                    date_time = dt.datetime.combine(date, dt.datetime.strptime(dep_time, '%H:%M').time())
+                    self.departures.setdefault(eva_number, []).append({'name': name, 'type': name.split()[0],
+                        'dateTime': date_time.strftime('%Y-%m-%dT%H:%M'), 'detailsId': details_id})
+
+                self.journeys[details_id].append(stop)
+
+        for departures in self.departures.values():
+            departures.sort(key=lambda departure: departure['dateTime'])
+
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+
+                with stub.lock:
+                    stub.num_requests += 1
+                    stub.request_times.append(time.monotonic())
+                    failure = stub.failures.pop(0) if stub.failures else None
+
+                if failure is not None:
+                    status, delay = failure
+                    time.sleep(delay)
+                    if status is not None:
+                        return self.send(status, {})
+
+                url = urllib.parse.urlparse(self.path)
+
+                if url.path.startswith('/departureBoard/'):
+                    eva_number = int(url.path.rsplit('/', 1)[1])
+                    date_time = urllib.parse.parse_qs(url.query)['date'][0][:16]
+                    self.send(200, [departure for departure in stub.departures.get(eva_number, [])
+                        if departure['dateTime'] >= date_time][:stub.page_size])
+
+                elif url.path.startswith('/journeyDetails/'):
+                    details_id = urllib.parse.unquote(url.path.split('/journeyDetails/', 1)[1])
+                    if details_id in stub.journeys:
+                        self.send(200, stub.journeys[details_id])
+                    else:
+                        self.send(404, {})
+
+                else:
+                    self.send(404, {})
+
+            def send(self, status, data):
+
+                body = json.dumps(data).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+    def get_parser(self, **kwargs):
+
+        # Parser crawling the stub
+
+        parser = db_api_parser('key', **kwargs)
+
+        url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        parser.url_departures = url + '/departureBoard/'
+        parser.url_journey_details = url + '/journeyDetails/'
+
+        return parser
+
+
+    def close(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class test_crawl(unittest.TestCase):
+
+    date = dt.date(2019, 6, 11)
+
+    # Three journeys of line STR 1 a day, and journeys passing several of the
+    # crawled stations
+    journeys = [
+        ('str1-0805', 'STR 1', [(8000001, None, '08:05'), (8000002, '08:15', '08:16'), (8000003, '08:30', None)]),
+        ('str1-1205', 'STR 1', [(8000001, None, '12:05'), (8000002, '12:15', '12:16'), (8000003, '12:30', None)]),
+        ('str1-1605', 'STR 1', [(8000001, None, '16:05'), (8000002, '16:15', '16:16'), (8000003, '16:30', None)]),
+        ('str1-back', 'STR 1', [(8000003, None, '09:00'), (8000002, '09:14', '09:15'), (8000001, '09:25', None)]),
+        ('bus-100-a', 'Bus 100', [(8000002, None, '07:00'), (8000004, '07:20', None)]),
+        ('bus-100-b', 'Bus 100', [(8000002, None, '07:30'), (8000004, '07:50', None)]),
+        ('ice-500', 'ICE 500', [(8000004, None, '23:50'), (8000001, '00:40', '00:42'), (8000003, '01:30', None)]),
+        ]
+
+    eva_numbers = [8000001, 8000002, 8000003, 8000004]
+
+    def setUp(self):
+
+        self.stub = db_api_stub(self.journeys, self.date)
+
+    def tearDown(self):
+
+        self.stub.close()
+
+    def get_trips(self, **kwargs):
+
+        start = dt.datetime.combine(self.date, dt.time(4, 0))
+        end = dt.datetime.combine(self.date, dt.time(23, 59))
+
+        return self.stub.get_parser(**kwargs).get_trips(start, end, self.eva_numbers)
+
+    def normalized(self, trips):
+
+        return {name: sorted(json.dumps(trip, sort_keys=True) for trip in trip_list) for name, trip_list in trips.items()}
+
+    def test_concurrent_crawl_matches_one_worker(self):
+
+        trips = self.get_trips(max_workers=1)
+        concurrent_trips = self.get_trips(max_workers=8)
+
+        self.assertEqual(self.normalized(trips), self.normalized(concurrent_trips))
+
+    def test_journeys_of_the_same_line_are_kept(self):
+
+        trips = self.get_trips(max_workers=8)
+
+        self.assertEqual(len(trips['STR 1']), 4)
+        self.assertEqual(len(trips['Bus 100']), 2)
+        self.assertEqual(sorted(trip[0]['dep_time'] for trip in trips['STR 1']),
+            ['2019-06-11T08:05:00', '2019-06-11T09:00:00', '2019-06-11T12:05:00', '2019-06-11T16:05:00'])
+
+    def test_journeys_are_requested_once(self):
+
+        parser = self.stub.get_parser(max_workers=8)
+        parser.get_trips(dt.datetime.combine(self.date, dt.time(4, 0)), dt.datetime.combine(self.date, dt.time(23, 59)),
+            self.eva_numbers)
+
+        self.assertEqual(parser.count_trip_requests, len(self.journeys))
+
+
+class test_requests(unittest.TestCase):
+
+    def setUp(self):
+
+        self.stub = db_api_stub(test_crawl.journeys, test_crawl.date)
+
+    def tearDown(self):
+
+        self.stub.close()
+
+    def get_trips(self, parser):
+
+        start = dt.datetime.combine(test_crawl.date, dt.time(4, 0))
+        end = dt.datetime.combine(test_crawl.date, dt.time(23, 59))
+
+        return parser.get_trips(start, end, test_crawl.eva_numbers)
+
+    def test_server_errors_are_retried(self):
+
+        expected = self.get_trips(self.stub.get_parser(max_workers=1))
+
+        parser = self.stub.get_parser(max_workers=1)
+        parser.retry_wait_time = 0.01
+        self.stub.failures = [(503, 0), (500, 0), (429, 0)]
+
+        trips = self.get_trips(parser)
+
+        self.assertEqual(test_crawl.normalized(self, trips), test_crawl.normalized(self, expected))
+        self.assertEqual(parser.count_server_errors, 2)
+        self.assertEqual(parser.count_rate_limited, 1)
+        self.assertEqual(parser.count_retries, 3)
+        self.assertEqual(parser.count_dep_requests_failed + parser.count_trip_requests_failed, 0)
+
+    def test_timeouts_are_retried(self):
+
+        expected = self.get_trips(self.stub.get_parser(max_workers=1))
+
+        parser = self.stub.get_parser(max_workers=1)
+        parser.retry_wait_time = 0.01
+        parser.max_wait_time = 0.2
+        self.stub.failures = [(None, 0.5)]
+
+        trips = self.get_trips(parser)
+
+        self.assertEqual(test_crawl.normalized(self, trips), test_crawl.normalized(self, expected))
+        self.assertEqual(parser.count_dep_requests_timeout, 1)
+        self.assertEqual(parser.count_retries, 1)
+
+    def test_failing_requests_give_up(self):
+
+        parser = self.stub.get_parser(max_workers=1)
+        parser.retry_wait_time = 0.01
+        parser.max_retries = 2
+        self.stub.failures = [(500, 0)] * 3
+
+        parser.request(parser.url_departures + '8000001', {'date': '2019-06-11T04:00'}, 'count_dep_requests')
+
+        self.assertEqual(parser.count_dep_requests, 3)
+        self.assertEqual(parser.count_dep_requests_failed, 1)
+        self.assertEqual(parser.count_retries, 2)
+
+    def test_rate_limit(self):
+
+        parser = self.stub.get_parser(max_workers=8, requests_per_minute=1200, rate_burst=4)
+
+        self.get_trips(parser)
+
+        request_times = self.stub.request_times
+
+        # Up to rate_burst requests at once, then 20 per second
+        self.assertGreaterEqual(request_times[-1] - request_times[0], (len(request_times) - 4) / 20 - 0.05)
+        self.assertLessEqual(max(sum(1 for t in request_times if start <= t < start + 1) for start in request_times), 20 + 4)
+
+
+class test_resume(unittest.TestCase):
+
+    def setUp(self):
+
+        self.stub = db_api_stub(test_crawl.journeys, test_crawl.date)
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.directory.name, 'crawl.journal')
+
+    def tearDown(self):
+
+        self.stub.close()
+        self.directory.cleanup()
+
+    def get_trips(self, parser, journal_file=None):
+
+        start = dt.datetime.combine(test_crawl.date, dt.time(4, 0))
+        end = dt.datetime.combine(test_crawl.date, dt.time(23, 59))
+
+        return parser.get_trips(start, end, test_crawl.eva_numbers, journal_file)
+
+    def test_killed_crawl_resumes(self):
+
+        # A crawl killed after any number of journal records, or while writing
+        # one, is completed by a resumed crawl
+
+        expected = test_crawl.normalized(self, self.get_trips(self.stub.get_parser(max_workers=1)))
+
+        self.get_trips(self.stub.get_parser(max_workers=4), self.journal_file)
+
+        with open(self.journal_file) as f:
+            lines = f.readlines()
+
+        for num_lines in range(len(lines)):
+            for torn in (False, True):
+
+                with open(self.journal_file, 'w') as f:
+                    f.writelines(lines[:num_lines])
+                    if torn:
+                        f.write(lines[num_lines][:len(lines[num_lines]) // 2])
+
+                parser = self.stub.get_parser(max_workers=4)
+                trips = self.get_trips(parser, self.journal_file)
+
+                self.assertEqual(test_crawl.normalized(self, trips), expected)
+                self.assertEqual(test_crawl.normalized(self, self.get_trips(self.stub.get_parser(max_workers=4),
+                    self.journal_file)), expected)
+
+        # The complete journal resumes the crawl without journey requests
+        parser = self.stub.get_parser(max_workers=4)
+        self.assertEqual(test_crawl.normalized(self, self.get_trips(parser, self.journal_file)), expected)
+        self.assertEqual(parser.count_trip_requests, 0)
+
+    def test_failed_crawl_resumes(self):
+
+        # Requests failing partway through leave their pages to the resumed crawl
+
+        expected = test_crawl.normalized(self, self.get_trips(self.stub.get_parser(max_workers=1)))
+
+        parser = self.stub.get_parser(max_workers=1)
+        parser.max_retries = 0
+        self.stub.failures = [(None, 0)] * 6 + [(500, 0)] * 1000
+
+        trips = self.get_trips(parser, self.journal_file)
+
+        self.assertNotEqual(test_crawl.normalized(self, trips), expected)
+
+        self.stub.failures = []
+        parser = self.stub.get_parser(max_workers=4)
+        trips = self.get_trips(parser, self.journal_file)
+
+        self.assertEqual(test_crawl.normalized(self, trips), expected)
+        self.assertGreater(parser.count_boards_resumed, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from name_index import name_index, normalize_name
+from timetable import timetable
+
+class test_name_index(unittest.TestCase):
+
+    names = ['Berlin Hbf', 'Frankfurt (Main) Hbf', 'Frankfurt (Oder)', 'Köln Hbf', 'Köln Messe/Deutz', 'München Hbf',
+        'Mainz Hbf', 'Offenbach (Main) Hbf', 'Straßburg']
+
+    def setUp(self):
+
+        self.index = name_index(self.names, list(range(len(self.names))))
+
+    def matched_names(self, search_str, k=10):
+
+        return [name for name, loc_id in self.index.search(search_str, k)]
+
+    def test_normalize_name(self):
+
+        self.assertEqual(normalize_name('  Köln Messe/Deutz '), 'koln messe deutz')
+        self.assertEqual(normalize_name('Straßburg'), 'strassburg')
+
+    def test_best_match(self):
+
+        self.assertEqual(self.index.search('frankfurt main', 1), [('Frankfurt (Main) Hbf', 1)])
+        self.assertEqual(self.matched_names('muenchen', 1), ['München Hbf'])
+        self.assertEqual(self.matched_names('strassburg', 1), ['Straßburg'])
+
+    def test_prefix_matches_first(self):
+
+        self.assertEqual(self.matched_names('kol'), ['Köln Hbf', 'Köln Messe/Deutz'])
+        self.assertEqual(self.matched_names('main')[0], 'Mainz Hbf')
+
+    def test_weak_matches_are_left_out(self):
+
+        self.assertEqual(self.matched_names('frankfurt main'), ['Frankfurt (Main) Hbf', 'Frankfurt (Oder)'])
+        self.assertEqual(self.matched_names('hamburg'), [])
+        self.assertEqual(self.matched_names(''), [])
+
+    def test_long_search_strings(self):
+
+        names = ['Flughafen Frankfurt am Main Fernbahnhof Terminal 1', 'Flughafen Frankfurt am Main Regionalbahnhof']
+        index = name_index(names, [1, 2])
+
+        self.assertEqual(index.search('frankfurt am main fernbahnhof', 2)[0], (names[0], 1))
+
+    def test_search_location(self):
+
+        t = timetable(None, None)
+        t.name_index = self.index
+
+        self.assertEqual(t.search_location('berlin'), ('Berlin Hbf', 0))
+        self.assertEqual(t.search_location('hamburg'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
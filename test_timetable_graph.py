@@ -0,0 +1,291 @@
+import os
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+from timetable_graph import timetable_graph
+
+begin = dt.datetime(2019, 6, 11)
+
+# Two trips A - B - C and a trip B - C, times in minutes after begin
+trips = {
+    'T1': [('A', 480, 480), ('B', 490, 491), ('C', 500, 500)],
+    'T2': [('A', 540, 540), ('B', 550, 551), ('C', 560, 560)],
+    'T3': [('B', 495, 495), ('C', 505, 505)],
+    }
+
+def get_graph(waiting_chains=False, max_transfer_time=60, trips=trips):
+
+    g = timetable_graph(begin, begin + dt.timedelta(days=1), waiting_chains)
+
+    for i, loc_id in enumerate('ABC'):
+        g.add_location(loc_id, 'Station ' + loc_id, 50 + i / 100, 8)
+
+    trip_ids = list(trips)
+    stops = [stop for trip_id in trip_ids for stop in trips[trip_id]]
+
+    g.add_trips(trip_ids, trip_ids, np.cumsum([0] + [len(trips[trip_id]) for trip_id in trip_ids]),
+        [stop[0] for stop in stops], [stop[1] for stop in stops], [stop[2] for stop in stops])
+    g.add_transfers(list('ABC'), list('ABC'), 2, max_transfer_time)
+
+    return g
+
+
+class test_update_trips(unittest.TestCase):
+
+    def stop_times(self, g, trip_id):
+
+        events = g.trip_stop_events([trip_id])
+
+        if trip_id not in events:
+            return None
+
+        loc_ids, arr, dep = events[trip_id]
+
+        return [(g.g.gp.location_ids[loc_id], a, d) for loc_id, a, d in zip(loc_ids.tolist(), arr.tolist(), dep.tolist())]
+
+    def test_update(self):
+
+        for waiting_chains in (False, True):
+            with self.subTest(waiting_chains=waiting_chains):
+                g = get_graph(waiting_chains)
+
+                self.assertEqual(g.update_trips(['T1'], [[485, 495, 505]], [[485, 496, 505]]), 1)
+
+                self.assertEqual(self.stop_times(g, 'T1'), [('A', 485, 485), ('B', 495, 496), ('C', 505, 505)])
+                self.assertEqual(self.stop_times(g, 'T2'), trips['T2'])
+                self.assertEqual(self.stop_times(g, 'T3'), trips['T3'])
+
+    def test_trip_of_other_edges(self):
+
+        # Transfer and waiting edges added by building, updating and loading a
+        # graph are on no trip
+
+        with tempfile.TemporaryDirectory() as directory:
+            for waiting_chains in (False, True):
+                with self.subTest(waiting_chains=waiting_chains):
+                    g = get_graph(waiting_chains)
+                    g.update_trips(['T1', 'T3'], [[485, 495, 505], None], [[485, 496, 505], None])
+
+                    filename = os.path.join(directory, 'graph')
+                    g.save_to_file(filename)
+
+                    loaded = timetable_graph()
+                    loaded.load_from_file(filename)
+
+                    for graph in (g, loaded):
+                        edges = graph.g.get_edges([graph.g.ep.is_transport, graph.g.ep.trip])
+                        self.assertTrue((edges[edges[:, 2] == 0, 3] == -1).all())
+                        self.assertTrue((edges[edges[:, 2] == 1, 3] >= 0).all())
+                        self.assertGreater((edges[:, 2] == 0).sum(), 0)
+
+    def test_cancellation(self):
+
+        g = get_graph()
+
+        self.assertEqual(g.update_trips(['T1'], [None], [None]), 1)
+
+        self.assertIsNone(self.stop_times(g, 'T1'))
+        self.assertEqual(self.stop_times(g, 'T2'), trips['T2'])
+        self.assertEqual(self.stop_times(g, 'T3'), trips['T3'])
+
+    def test_mismatched_update(self):
+
+        # A trip is neither changed nor canceled by times that do not match its stops
+
+        g = get_graph()
+        num_edges = g.g.num_edges()
+
+        with self.assertRaises(ValueError):
+            g.update_trips(['T2', 'T1'], [[545, 555, 565], [485, 495]], [[545, 556, 565], [485, 495]])
+
+        self.assertEqual(g.g.num_edges(), num_edges)
+
+        for trip_id, stops in trips.items():
+            self.assertEqual(self.stop_times(g, trip_id), stops)
+
+    def test_unknown_trips_are_skipped(self):
+
+        g = get_graph()
+
+        self.assertEqual(g.update_trips(['T9'], [[1, 2]], [[1, 2]]), 0)
+
+
+class test_waiting_chains(unittest.TestCase):
+
+    def arrival(self, g, from_loc_id, to_loc_id, minutes):
+
+        paths = g.find_shortest_paths(from_loc_id, to_loc_id, begin + dt.timedelta(minutes=minutes), 1)
+
+        return int(g.g.vp.timestamp.a[paths[0][-1]]) if paths else None
+
+    def test_same_arrivals_without_transfer_limit(self):
+
+        graphs = [get_graph(waiting_chains, 24 * 60) for waiting_chains in (False, True)]
+
+        for from_loc_id in 'ABC':
+            for to_loc_id in 'ABC':
+                for minutes in (0, 479, 489, 494, 500, 539, 549):
+                    with self.subTest(from_loc_id=from_loc_id, to_loc_id=to_loc_id, minutes=minutes):
+                        self.assertEqual(*(self.arrival(g, from_loc_id, to_loc_id, minutes) for g in graphs))
+
+    def test_transfer_limit_at_boarding(self):
+
+        # The only connection from A to C changes at B after 30 minutes
+
+        connecting_trips = {'U1': [('A', 480, 480), ('B', 490, 490)], 'U2': [('B', 520, 520), ('C', 530, 530)]}
+
+        for waiting_chains in (False, True):
+            with self.subTest(waiting_chains=waiting_chains):
+                self.assertEqual(self.arrival(get_graph(waiting_chains, 60, connecting_trips), 'A', 'C', 479), 530)
+                self.assertIsNone(self.arrival(get_graph(waiting_chains, 20, connecting_trips), 'A', 'C', 479))
+
+
+class test_time_window(unittest.TestCase):
+
+    def test_paths_within_window(self):
+
+        g = get_graph()
+        dep_time = begin + dt.timedelta(minutes=479)
+
+        paths = g.find_shortest_paths('A', 'C', dep_time, 1, view=g.time_window_view(dep_time, begin + dt.timedelta(minutes=500)))
+        self.assertEqual(paths[0].tolist(), g.find_shortest_paths('A', 'C', dep_time, 1)[0].tolist())
+
+        # T1 arrives at C at 500, T2 leaves A at 540
+        window = g.time_window_view(dep_time, begin + dt.timedelta(minutes=530))
+        self.assertEqual(g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=480), 1, view=window), [])
+
+
+class test_isochrones(unittest.TestCase):
+
+    def test_buckets(self):
+
+        g = get_graph()
+
+        buckets = g.find_isochrones('A', begin + dt.timedelta(minutes=479), time_step=10, max_travel_time=30)
+
+        self.assertEqual([[location['loc_id'] for location in bucket] for bucket in buckets], [['A'], ['B'], ['C']])
+        self.assertEqual(buckets[2][0]['travel_time'], 21)
+
+    def test_departure_before_begin(self):
+
+        with self.assertRaises(ValueError):
+            get_graph().find_isochrones('A', begin - dt.timedelta(minutes=1))
+
+
+class test_od_matrix(unittest.TestCase):
+
+    def test_workers_match_one_process(self):
+
+        g = get_graph()
+        dep_times = [begin + dt.timedelta(minutes=479), begin + dt.timedelta(minutes=539)]
+
+        matrix = g.od_matrix(['A', 'B'], ['B', 'C'], dep_times, processes=1)
+
+        self.assertEqual(matrix[0].tolist(), [[11, 21], [0, 21]])
+        self.assertTrue(np.array_equal(g.od_matrix(['A', 'B'], ['B', 'C'], dep_times, processes=2, chunksize=1), matrix))
+
+    def test_departure_before_begin(self):
+
+        with self.assertRaises(ValueError):
+            get_graph().od_matrix(['A'], ['C'], [begin + dt.timedelta(minutes=479), begin - dt.timedelta(minutes=1)])
+
+
+class test_query_cache(unittest.TestCase):
+
+    def test_departure_minutes(self):
+
+        # Only queries departing in the same minute share paths, a later departure
+        # must not get paths boarding before it
+
+        g = get_graph()
+        g.enable_query_cache()
+
+        paths = g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=479), 1)
+        later_paths = g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=480), 1)
+
+        self.assertEqual(g.query_cache_stats()['hits'], 0)
+        self.assertEqual(g.g.vp.timestamp.a[paths[0][0]], 480)
+        self.assertEqual(g.g.vp.timestamp.a[later_paths[0][0]], 540)
+
+        cached_paths = g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=479), 1)
+
+        self.assertEqual(g.query_cache_stats()['hits'], 1)
+        self.assertEqual(cached_paths[0].tolist(), paths[0].tolist())
+
+    def test_cached_paths_are_not_changed(self):
+
+        g = get_graph()
+        g.enable_query_cache()
+
+        paths = g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=479), 1)
+        expected = paths[0].tolist()
+        paths[0][:] = 0
+        paths.clear()
+
+        cached_paths = g.find_shortest_paths('A', 'C', begin + dt.timedelta(minutes=479), 1)
+
+        self.assertEqual(cached_paths[0].tolist(), expected)
+
+        with self.assertRaises(ValueError):
+            cached_paths[0][0] = 0
+
+
+class test_save(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'graph')
+
+    def tearDown(self):
+
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+
+        g = get_graph()
+        g.save_to_file(self.filename)
+
+        loaded = timetable_graph()
+        loaded.load_from_file(self.filename)
+
+        for name in ('location_ids', 'location_names', 'location_index', 'trip_ids', 'trip_names', 'trip_index'):
+            self.assertEqual(loaded.g.gp[name], g.g.gp[name])
+
+        self.assertEqual(loaded.find_locations('station b'), g.find_locations('station b'))
+        self.assertEqual(loaded.trip_stop_events(['T1'])['T1'][1].tolist(), [480, 490, 500])
+
+        # Saved over the files the loaded graph maps
+        loaded.update_trips(['T1'], [None], [None])
+        loaded.save_to_file(self.filename)
+
+        reloaded = timetable_graph()
+        reloaded.load_from_file(self.filename)
+
+        self.assertEqual(reloaded.trip_stop_events(['T1', 'T2']).keys(), {'T2'})
+
+    def test_mixed_ids(self):
+
+        g = timetable_graph(begin, begin + dt.timedelta(days=1))
+        g.add_location('A', 'Station A', 50, 8)
+        g.add_location(8000002, 'Station B', 50.01, 8)
+        g.save_to_file(self.filename)
+
+        loaded = timetable_graph()
+        loaded.load_from_file(self.filename)
+
+        self.assertEqual(loaded.g.gp.location_ids, ['A', 8000002])
+        self.assertEqual(loaded.g.gp.location_index, {'A': 0, 8000002: 1})
+
+    def test_graph_file(self):
+
+        with open(self.filename + '.gt', 'wb') as f:
+            f.write(b'graph')
+
+        with self.assertRaisesRegex(ValueError, 'must be rebuilt'):
+            timetable_graph().load_from_file(self.filename + '.gt')
+
+
+if __name__ == '__main__':
+    unittest.main()
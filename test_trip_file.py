@@ -0,0 +1,140 @@
+import os
+import tempfile
+import unittest
+import importlib.util
+from trip_file import trip_file, is_trip_file
+from timetable import timetable
+
+class test_trip_file(unittest.TestCase):
+
+    trips = {
+        'STR 1': [
+            [{'station': 'A', 'dep_time': '2019-06-11T08:05:00'}, {'station': 'B', 'arr_time': '2019-06-11T08:15:00'}],
+            [{'station': 'A', 'dep_time': '2019-06-11T12:05:00'}, {'station': 'B', 'arr_time': '2019-06-11T12:15:00'}],
+            ],
+        'ICE 500': [
+            [{'station': 'Köln Hbf', 'dep_time': '2019-06-11T23:50:00'}, {'station': 'B', 'arr_time': '2019-06-12T00:40:00'}],
+            ],
+        'Bus 100': [],
+        }
+
+    suffixes = ['.ndjson', '.jsonl.gz', '.ndjson.zst']
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+
+        self.directory.cleanup()
+
+    def get_filename(self, suffix):
+
+        if suffix.endswith('.zst') and importlib.util.find_spec('zstandard') is None:
+            self.skipTest('zstandard is not installed')
+
+        return os.path.join(self.directory.name, 'trips' + suffix)
+
+    def stored_trips(self, trips):
+
+        # Trip names without any trips are not stored
+
+        return {trip_name: trip_list for trip_name, trip_list in trips.items() if len(trip_list) > 0}
+
+    def collected(self, items):
+
+        trips = {}
+
+        for trip_name, trip_list in items:
+            trips.setdefault(trip_name, []).extend(trip_list)
+
+        return trips
+
+    def test_is_trip_file(self):
+
+        for suffix in self.suffixes:
+            self.assertTrue(is_trip_file('trips' + suffix))
+
+        self.assertFalse(is_trip_file('trips.json'))
+        self.assertFalse(is_trip_file('trips.json.gz'))
+
+    def test_round_trip(self):
+
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                filename = self.get_filename(suffix)
+
+                trip_file(filename).write(self.trips)
+
+                self.assertEqual(self.collected(trip_file(filename).items()), self.stored_trips(self.trips))
+
+    def test_streamed_writes(self):
+
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                filename = self.get_filename(suffix)
+
+                f = trip_file(filename)
+                f.open()
+                for trip_name, trip_list in self.trips.items():
+                    for trip in trip_list:
+                        f.write_trip(trip_name, trip)
+                f.close()
+
+                self.assertEqual(list(trip_file(filename).read()),
+                    [(trip_name, trip) for trip_name, trip_list in self.trips.items() for trip in trip_list])
+
+    def test_rewrite(self):
+
+        # A trip file written to another format, and to its own file
+
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                filename = self.get_filename(suffix)
+                trip_file(filename).write(self.trips)
+
+                copy = self.get_filename('.copy' + suffix)
+                trip_file(copy).write(trip_file(filename))
+                trip_file(filename).write(trip_file(filename))
+
+                self.assertEqual(self.collected(trip_file(copy).items()), self.stored_trips(self.trips))
+                self.assertEqual(self.collected(trip_file(filename).items()), self.stored_trips(self.trips))
+
+    def test_failed_write_keeps_file(self):
+
+        filename = self.get_filename('.ndjson')
+        trip_file(filename).write(self.trips)
+
+        def failing_items():
+            yield 'STR 1', self.trips['STR 1']
+            raise RuntimeError('interrupted')
+
+        class failing_trips:
+            def items(self):
+                return failing_items()
+
+        with self.assertRaises(RuntimeError):
+            trip_file(filename).write(failing_trips())
+
+        self.assertEqual(os.listdir(self.directory.name), ['trips.ndjson'])
+        self.assertEqual(self.collected(trip_file(filename).items()), self.stored_trips(self.trips))
+
+    def test_timetable_trips(self):
+
+        # Trips of a timetable loaded from a trip file are read again on each
+        # iteration
+
+        for suffix in self.suffixes:
+            with self.subTest(suffix=suffix):
+                filename = self.get_filename(suffix)
+                trip_file(filename).write(self.trips)
+
+                t = timetable(None, None)
+                t.load_trips_from_file(filename)
+
+                self.assertEqual(self.collected(t.trips.items()), self.stored_trips(self.trips))
+                self.assertEqual(self.collected(t.trips.items()), self.stored_trips(self.trips))
+
+
+if __name__ == '__main__':
+    unittest.main()
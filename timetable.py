@@ -1,8 +1,9 @@
 import json
 import datetime
-from difflib import get_close_matches
 from geopy import distance
 from graph_tool.all import *
+from name_index import name_index
+from trip_file import trip_file, is_trip_file
 
 class timetable:
 
@@ -13,6 +14,13 @@ class timetable:
 
     def load_trips_from_file(self, filename):
 
+        # Trip files (.ndjson or .jsonl, optionally .gz or .zst) are not loaded
+        # into memory but read trip by trip whenever the trips are iterated
+
+        if is_trip_file(filename):
+            self.trips = trip_file(filename)
+            return
+
         with open(filename, 'r') as f:
             self.trips = json.load(f)
 
@@ -81,6 +89,7 @@ class timetable:
         self.g = self.initialize_graph()
 
         self.locations = self.get_locations_from_trips(self.trips, max_transfer_distance)
+        self.name_index = name_index([loc['name'] for loc in self.locations.values()], list(self.locations.keys()))
 
         self.departure_vertices = {}
         self.arrival_vertices = {}
@@ -257,15 +266,14 @@ class timetable:
 
     def search_location(self, search_string):
 
-        loc_names = [v['name'] for k, v in self.locations.items()]
-
-        result =  get_close_matches(search_string, loc_names, n=1)
+        # Best match as (name, loc_id), (None, None) if no name matches
 
-        loc_name_found = result[0]
+        result = self.name_index.search(search_string, 1)
 
-        loc_id_found = next((x[0] for x in self.locations.items() if x[1]['name'] == loc_name_found), None)
+        if len(result) == 0:
+            return None, None
 
-        return loc_name_found, loc_id_found
+        return result[0]
 
 
     def find_route(self, from_loc_id, to_loc_id, dep_time):
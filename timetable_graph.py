@@ -1,145 +1,1617 @@
 import datetime as dt
+import os
+import time
+import heapq
+import pickle
+import collections
+import threading
+import multiprocessing
+import numpy as np
 from graph_tool.all import *
-from difflib import get_close_matches
-from geopy import distance
+from connection_scan import connection_scan
+from raptor import raptor
+from name_index import name_index
+from gtfs_realtime import read_trip_updates, local_datetime
+
+def expand_ranges(starts, ends):
+
+    # Range number and position of every element of the ranges starts[i]:ends[i]
+
+    counts = ends - starts
+
+    rows = np.repeat(np.arange(len(starts)), counts)
+    positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+    return rows, positions
+
+
+def object_arrays(name, obj):
+
+    # Array attributes of an index object, keyed for saving as name.attribute
+
+    return {name + '.' + attribute: value for attribute, value in vars(obj).items() if isinstance(value, np.ndarray)}
+
+
+def table_array(values):
+
+    # Id or name table as an array if it holds only strings or only integers,
+    # None for tables of other or mixed values
+
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype=str)
+
+    if all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in values):
+        return np.array(values, dtype=np.int64)
+
+    return None
+
+
+def object_from_arrays(cls, name, arrays):
+
+    # Index object with its attributes set from saved arrays, without rebuilding it
+
+    obj = cls.__new__(cls)
+
+    for key, value in arrays.items():
+        if key.startswith(name + '.'):
+            setattr(obj, key[len(name) + 1:], value)
+
+    return obj
+
+
+def od_matrix_row(graph, to_loc_indices, task):
+
+    # Travel times from one origin at one departure time to all destinations
+
+    time_index, origin_index, from_loc_index, dep_timestamp = task
+
+    arrivals = graph.get_connection_scan().earliest_arrivals(from_loc_index, dep_timestamp)
+
+    return time_index, origin_index, arrivals[to_loc_indices] - dep_timestamp
+
+
+# Graph and destinations of the od_matrix call of a worker process, set by the
+# pool initializer
+od_matrix_worker = None
+
+def od_matrix_init(graph, to_loc_indices):
+
+    global od_matrix_worker
+
+    od_matrix_worker = (graph, to_loc_indices)
+
+
+def od_matrix_worker_row(task):
+
+    return od_matrix_row(*od_matrix_worker, task)
+
+
+class event_index:
+
+    # Departure or arrival vertices grouped by location (CSR style): the events
+    # of location i are at offsets[i]:offsets[i+1], sorted by timestamp
+
+    def __init__(self, loc_ids, timestamps, vertices, num_locations):
+
+        order = np.lexsort((timestamps, loc_ids))
+
+        self.timestamps = np.asarray(timestamps, dtype=np.int32)[order]
+        self.vertices = np.asarray(vertices, dtype=np.int64)[order]
+
+        self.offsets = np.zeros(num_locations + 1, dtype=np.int64)
+        np.cumsum(np.bincount(loc_ids, minlength=num_locations), out=self.offsets[1:])
+
+
+    def events(self, loc_id, after=None, before=None):
+
+        # Timestamps and vertices of the events at loc_id with after < timestamp < before
+
+        if loc_id >= len(self.offsets) - 1:
+            return self.timestamps[:0], self.vertices[:0]
+
+        timestamps = self.timestamps[self.offsets[loc_id]:self.offsets[loc_id + 1]]
+        vertices = self.vertices[self.offsets[loc_id]:self.offsets[loc_id + 1]]
+
+        first = 0 if after is None else np.searchsorted(timestamps, after, side='right')
+        last = len(timestamps) if before is None else np.searchsorted(timestamps, before, side='left')
+
+        return timestamps[first:last], vertices[first:last]
+
+
+    def find(self, loc_id, timestamp):
+
+        timestamps, vertices = self.events(loc_id, timestamp - 1, timestamp + 1)
+
+        if len(vertices) == 0:
+            return None
+
+        return vertices[0]
+
+
+    def keys(self, loc_ids=None, timestamps=None):
+
+        # Sort keys combining location and timestamp, used for vectorized searches
+
+        if loc_ids is None:
+            loc_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+            timestamps = self.timestamps
+
+        return (np.asarray(loc_ids, dtype=np.int64) << 32) + (np.asarray(timestamps, dtype=np.int64) + 2**31)
+
+
+    def updated(self, removed_vertices, loc_ids, timestamps, vertices, num_locations):
+
+        # Copy of the index without removed_vertices and with the given events added.
+        # The new events are merged into the sorted arrays, which are not sorted again.
+
+        keep = ~np.isin(self.vertices, removed_vertices)
+        kept_locs = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))[keep]
+        kept_keys = self.keys(kept_locs, self.timestamps[keep])
+
+        loc_ids = np.asarray(loc_ids, dtype=np.int64)
+        order = np.lexsort((timestamps, loc_ids))
+        loc_ids = loc_ids[order]
+        timestamps = np.asarray(timestamps, dtype=np.int64)[order]
+
+        positions = np.searchsorted(kept_keys, self.keys(loc_ids, timestamps), side='right')
+
+        index = event_index.__new__(event_index)
+
+        index.timestamps = np.insert(self.timestamps[keep], positions, timestamps.astype(np.int32))
+        index.vertices = np.insert(self.vertices[keep], positions, np.asarray(vertices, dtype=np.int64)[order])
+
+        index.offsets = np.zeros(num_locations + 1, dtype=np.int64)
+        np.cumsum(np.bincount(kept_locs, minlength=num_locations) + np.bincount(loc_ids, minlength=num_locations),
+            out=index.offsets[1:])
+
+        return index
+
+
+    def find_many(self, loc_ids, timestamps):
+
+        if len(self.vertices) == 0:
+            return np.full(len(loc_ids), -1, dtype=np.int64)
+
+        keys = self.keys()
+        query_keys = self.keys(loc_ids, timestamps)
+
+        positions = np.minimum(np.searchsorted(keys, query_keys), len(keys) - 1)
+
+        return np.where(keys[positions] == query_keys, self.vertices[positions], -1)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+
+    # Great circle distance in meters, vectorized over arrays of coordinates
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+class location_grid:
+
+    # Locations bucketed into a lat / lon grid, sorted by (row, column) cell key
+    # so the cells of one grid row within a bounding box are one contiguous range
+
+    # Cell edge length in degrees
+    cell_size = 0.01
+
+    # Meters per degree of latitude
+    meters_per_degree = 111195.0
+
+    def __init__(self, latitudes, longitudes):
+
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+
+        locations = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        keys = self.keys(latitudes[locations], longitudes[locations])
+
+        order = np.argsort(keys, kind='stable')
+
+        self.keys_sorted = keys[order]
+        self.locations = locations[order]
+        self.latitudes = latitudes[self.locations]
+        self.longitudes = longitudes[self.locations]
+
+    def cells(self, latitudes, longitudes):
+
+        return (np.floor(np.asarray(latitudes) / self.cell_size).astype(np.int64),
+            np.floor(np.asarray(longitudes) / self.cell_size).astype(np.int64))
+
+    def keys(self, latitudes, longitudes):
+
+        rows, columns = self.cells(latitudes, longitudes)
+
+        return (rows << 17) + columns + (1 << 16)
+
+    def within(self, latitude, longitude, radius):
+
+        # Indices of the locations within radius meters and their distances
+
+        lat_delta = radius / self.meters_per_degree
+        max_lat = min(abs(latitude) + lat_delta, 89.0)
+        lon_delta = min(lat_delta / np.cos(np.radians(max_lat)), 180.0)
+
+        (first_row, first_column), (last_row, last_column) = (self.cells(latitude - lat_delta, longitude - lon_delta),
+            self.cells(latitude + lat_delta, longitude + lon_delta))
+
+        rows = np.arange(first_row, last_row + 1)
+
+        starts = np.searchsorted(self.keys_sorted, (rows << 17) + first_column + (1 << 16), side='left')
+        ends = np.searchsorted(self.keys_sorted, (rows << 17) + last_column + (1 << 16), side='right')
+
+        _, candidates = expand_ranges(starts, ends)
+
+        distances = haversine(latitude, longitude, self.latitudes[candidates], self.longitudes[candidates])
+        is_within = distances < radius
+
+        return self.locations[candidates[is_within]], distances[is_within]
+
+
+class query_cache:
+
+    # Least recently used query results, each kept for at most ttl seconds
+
+    def __init__(self, max_size, ttl):
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+
+    def get(self, key):
+
+        # (True, result) for a valid entry, (False, None) otherwise
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return True, entry[1]
+
+
+    def put(self, key, result):
+
+        with self.lock:
+
+            self.entries[key] = (time.monotonic() + self.ttl, result)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def clear(self):
+
+        with self.lock:
+            if len(self.entries) > 0:
+                self.entries.clear()
+                self.invalidations += 1
+
+
+    def stats(self):
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'invalidations': self.invalidations, 'size': len(self.entries)}
+
+
+class time_window:
+
+    # Vertices with first_timestamp <= timestamp <= last_timestamp, as returned by
+    # time_window_view. Searches only test the timestamps of the vertices they
+    # reach, nothing is allocated over all vertices.
+
+    def __init__(self, first_timestamp, last_timestamp):
+
+        self.first_timestamp = first_timestamp
+        self.last_timestamp = last_timestamp
+
+    def contains(self, timestamps):
+
+        return (timestamps >= self.first_timestamp) & (timestamps <= self.last_timestamp)
+
+
+class adjacency:
+
+    # Out- and in-neighbours of all vertices as CSR arrays. Every edge lasts the
+    # timestamp difference of its vertices, so all paths to a vertex take equally
+    # long and a route search only has to find the reachable vertices in time order.
+
+    def __init__(self, g):
+
+        num_vertices = g.num_vertices()
+        edges = g.get_edges()
+
+        order = np.argsort(edges[:, 0], kind='stable')
+        self.out_targets = edges[order, 1]
+        self.out_offsets = np.zeros(num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 0], minlength=num_vertices), out=self.out_offsets[1:])
+
+        order = np.argsort(edges[:, 1], kind='stable')
+        self.in_sources = edges[order, 0]
+        self.in_offsets = np.zeros(num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 1], minlength=num_vertices), out=self.in_offsets[1:])
+
+
+    def reach(self, sources, targets, target_costs, timestamps, time_step, allowed=None):
+
+        # Marks the vertices reachable from sources until no unexpanded vertex can
+        # lead to a target with a lower timestamp + target cost than the best one.
+        # With allowed, a boolean array over all vertices or a time_window, the
+        # search stays on the allowed vertices.
+
+        reached = np.zeros(len(self.out_offsets) - 1, dtype=bool)
+
+        if isinstance(allowed, time_window):
+            is_allowed = lambda vertices: allowed.contains(timestamps[vertices])
+        elif allowed is not None:
+            is_allowed = lambda vertices: allowed[vertices]
+
+        if allowed is not None:
+            sources = np.asarray(sources)[is_allowed(sources)]
+
+        order = np.argsort(targets)
+        targets = np.asarray(targets)[order]
+        target_costs = np.asarray(target_costs, dtype=float)[order]
+        min_target_cost = target_costs.min() if len(target_costs) > 0 else 0
+
+        best_cost = np.inf
+
+        pending = np.unique(sources)
+        reached[pending] = True
+
+        while len(pending) > 0:
+
+            best_cost = min(best_cost, self.target_cost(pending, targets, target_costs, timestamps))
+
+            earliest = timestamps[pending].min()
+
+            if earliest + min_target_cost > best_cost:
+                break
+
+            horizon = earliest + time_step
+
+            is_due = timestamps[pending] <= horizon
+            frontier = pending[is_due]
+            pending = pending[~is_due]
+
+            while len(frontier) > 0:
+
+                _, positions = expand_ranges(self.out_offsets[frontier], self.out_offsets[frontier + 1])
+
+                new = self.out_targets[positions]
+                new = new[~reached[new]] if allowed is None else new[~reached[new] & is_allowed(new)]
+                new = np.unique(new)
+                reached[new] = True
+
+                is_due = timestamps[new] <= horizon
+                frontier = new[is_due]
+                pending = np.concatenate((pending, new[~is_due]))
+
+                best_cost = min(best_cost, self.target_cost(frontier, targets, target_costs, timestamps))
+
+        return reached, best_cost
+
+
+    def target_cost(self, vertices, targets, target_costs, timestamps):
+
+        if len(vertices) == 0 or len(targets) == 0:
+            return np.inf
+
+        positions = np.minimum(np.searchsorted(targets, vertices), len(targets) - 1)
+        is_target = targets[positions] == vertices
+
+        if not is_target.any():
+            return np.inf
+
+        return (timestamps[vertices[is_target]] + target_costs[positions[is_target]]).min()
+
+
+    def iterate_paths(self, target, reached, sources):
+
+        # Depth first search back from target along reached predecessors
+
+        path = [target]
+        on_path = {target}
+        branches = [iter(self.in_sources[self.in_offsets[target]:self.in_offsets[target + 1]].tolist())]
+
+        if target in sources:
+            yield np.array(path)
+            return
+
+        while branches:
+
+            for u in branches[-1]:
+
+                if not reached[u] or u in on_path:
+                    continue
+
+                if u in sources:
+                    yield np.array([u] + path[::-1])
+                    continue
+
+                path.append(u)
+                on_path.add(u)
+                branches.append(iter(self.in_sources[self.in_offsets[u]:self.in_offsets[u + 1]].tolist()))
+                break
+
+            else:
+                branches.pop()
+                on_path.discard(path.pop())
+
 
 class timetable_graph:
 
-    def __init__(self, begin=None, end=None):     
+    # Width of the time buckets the route search expands vertices in, in minutes
+    search_time_step = 10
+
+    def __init__(self, begin=None, end=None, waiting_chains=False):
+
+        self.init_graph(begin, end, waiting_chains)
+
+        # Vertices added since the last update of the departure / arrival index
+        self.new_vertices = {}
+        self.index_outdated = True
+
+        self.lock = threading.RLock()
+        self.query_cache = None
+        self.reset_search_data()
+
+
+    def init_graph(self, begin, end, waiting_chains):
+
+        self.g = Graph()
+
+        self.g.gp.begin = self.g.new_graph_property('object')
+        self.g.gp.begin = begin
+
+        self.g.gp.end = self.g.new_graph_property('object')
+        self.g.gp.end = end
+
+        # With waiting chains, arrivals are linked to the first reachable departure
+        # only, later departures are reached by waiting along the chain
+        self.g.gp.waiting_chains = self.g.new_graph_property('bool')
+        self.g.gp.waiting_chains = waiting_chains
+
+        # Locations are interned to dense indices: key, name and coordinates of
+        # location i are location_ids[i], location_names[i], location_lats[i] and
+        # location_lons[i], vp.loc_id holds the index
+
+        self.g.gp.location_ids = self.g.new_graph_property('object')
+        self.g.gp.location_ids = []
+
+        self.g.gp.location_index = self.g.new_graph_property('object')
+        self.g.gp.location_index = {}
+
+        self.g.gp.location_names = self.g.new_graph_property('object')
+        self.g.gp.location_names = []
+
+        self.g.gp.location_lats = self.g.new_graph_property('object')
+        self.g.gp.location_lats = np.zeros(0)
+
+        self.g.gp.location_lons = self.g.new_graph_property('object')
+        self.g.gp.location_lons = np.zeros(0)
+
+        self.g.gp.departure_index = self.g.new_graph_property('object')
+        self.g.gp.departure_index = None
+
+        self.g.gp.arrival_index = self.g.new_graph_property('object')
+        self.g.gp.arrival_index = None
+
+        self.g.gp.waiting_index = self.g.new_graph_property('object')
+        self.g.gp.waiting_index = None
+
+        self.g.gp.time_index = self.g.new_graph_property('object')
+        self.g.gp.time_index = None
+
+        self.g.gp.location_grid = self.g.new_graph_property('object')
+        self.g.gp.location_grid = None
+
+        # Built on the first name search after locations changed
+        self.g.gp.name_index = self.g.new_graph_property('object')
+        self.g.gp.name_index = None
+
+        # Rows of (from location, to location, min transfer time, max transfer time)
+        # of all added transfers
+        self.g.gp.transfers = self.g.new_graph_property('object')
+        self.g.gp.transfers = np.zeros((0, 4), dtype=np.int64)
+
+        # Trips are interned the same way, ep.trip holds the index on transport edges
+        # and -1 on all other edges, set wherever edges are added
+
+        self.g.gp.trip_ids = self.g.new_graph_property('object')
+        self.g.gp.trip_ids = []
+
+        self.g.gp.trip_index = self.g.new_graph_property('object')
+        self.g.gp.trip_index = {}
+
+        self.g.gp.trip_names = self.g.new_graph_property('object')
+        self.g.gp.trip_names = []
+
+        # Vertices without edges left behind by update_trips, reused for new vertices
+        self.g.gp.free_vertices = self.g.new_graph_property('object')
+        self.g.gp.free_vertices = np.zeros(0, dtype=np.int64)
+
+        self.g.vp.loc_id = self.g.new_vertex_property('int32_t')
+        self.g.vp.timestamp = self.g.new_vertex_property('int32_t')
+        self.g.vp.is_departure = self.g.new_vertex_property('bool')
+        self.g.vp.is_waiting = self.g.new_vertex_property('bool')
+
+        self.g.ep.duration = self.g.new_edge_property('int32_t')
+        self.g.ep.is_transport = self.g.new_edge_property('bool')
+        self.g.ep.is_stationary = self.g.new_edge_property('bool')
+        self.g.ep.is_transfer = self.g.new_edge_property('bool')
+        self.g.ep.is_waiting = self.g.new_edge_property('bool')
+        self.g.ep.trip = self.g.new_edge_property('int32_t')
+
+
+    def add_location(self, loc_id, name, latitude, longitude):
+
+        self.add_locations([loc_id], [name], [latitude], [longitude])
+
+
+    def add_locations(self, loc_ids, names, latitudes, longitudes):
+
+        # Adds new locations or updates the name and coordinates of known ones
+
+        for loc_id in loc_ids:
+            if loc_id not in self.g.gp.location_index:
+                self.g.gp.location_index[loc_id] = len(self.g.gp.location_ids)
+                self.g.gp.location_ids.append(loc_id)
+                self.g.gp.location_names.append(None)
+
+        loc_indices = np.array([self.g.gp.location_index[loc_id] for loc_id in loc_ids], dtype=np.int64)
+
+        for loc_index, name in zip(loc_indices.tolist(), names):
+            self.g.gp.location_names[loc_index] = name
+
+        num_new = len(self.g.gp.location_ids) - len(self.g.gp.location_lats)
+
+        # Copied rather than written in place, loaded arrays are read-only
+        lats = np.concatenate((self.g.gp.location_lats, np.full(num_new, np.nan)))
+        lons = np.concatenate((self.g.gp.location_lons, np.full(num_new, np.nan)))
+        lats[loc_indices] = np.asarray(latitudes, dtype=float)
+        lons[loc_indices] = np.asarray(longitudes, dtype=float)
+
+        self.g.gp.location_lats = lats
+        self.g.gp.location_lons = lons
+
+        self.g.gp.name_index = None
+        self.index_outdated = True
+
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+
+    def intern_trips(self, trip_ids, trip_names):
+
+        # Dense indices of the trips, known trips get their name updated
+
+        trip_indices = np.empty(len(trip_ids), dtype=np.int32)
+
+        for i, (trip_id, trip_name) in enumerate(zip(trip_ids, trip_names)):
+
+            trip_index = self.g.gp.trip_index.get(trip_id)
+
+            if trip_index is None:
+                trip_index = len(self.g.gp.trip_ids)
+                self.g.gp.trip_index[trip_id] = trip_index
+                self.g.gp.trip_ids.append(trip_id)
+                self.g.gp.trip_names.append(trip_name)
+            else:
+                self.g.gp.trip_names[trip_index] = trip_name
+
+            trip_indices[i] = trip_index
+
+        return trip_indices
+
+
+    def add_trip(self, loc_ids, dep_times, arr_times, trip_id, trip_name):
+
+        trip = int(self.intern_trips([trip_id], [trip_name])[0])
+
+        current_vertex = self.add_vertex(loc_ids[0], dep_times[0])
+
+        for i in range(len(loc_ids) - 2):
+
+            arrival_vertex = self.add_vertex(loc_ids[i+1], arr_times[i], is_departure=False)
+
+            self.add_edge(current_vertex, arrival_vertex, is_transport=True, trip=trip)
+
+            current_vertex = arrival_vertex
+
+            departure_vertex = self.add_vertex(loc_ids[i+1], dep_times[i+1])
+
+            self.add_edge(current_vertex, departure_vertex, is_transport=True, is_stationary=True, trip=trip)
+
+            current_vertex = departure_vertex
+
+        
+        destination_vertex = self.add_vertex(loc_ids[-1], arr_times[-1], is_departure=False)
+
+        self.add_edge(current_vertex, destination_vertex, is_transport=True, trip=trip)
+
+        return
+
+
+    def add_trips(self, trip_ids, trip_names, trip_offsets, loc_ids, arr_timestamps, dep_timestamps):
+
+        # Bulk version of add_trip: the stop events of trip k are found at
+        # trip_offsets[k]:trip_offsets[k+1] of loc_ids and the timestamp arrays,
+        # timestamps are given in minutes after begin.
+
+        trip_offsets = np.asarray(trip_offsets, dtype=np.int64)
+        loc_ids = np.asarray(loc_ids)
+        arr_timestamps = np.asarray(arr_timestamps, dtype=np.int64)
+        dep_timestamps = np.asarray(dep_timestamps, dtype=np.int64)
+
+        num_events = len(loc_ids)
+
+        trip_indices = self.intern_trips(trip_ids, trip_names)
+
+        is_first = np.zeros(num_events, dtype=bool)
+        is_first[trip_offsets[:-1][trip_offsets[:-1] < num_events]] = True
+        is_last = np.zeros(num_events, dtype=bool)
+        is_last[trip_offsets[1:][trip_offsets[1:] > 0] - 1] = True
+
+        event_trips = np.repeat(trip_indices, np.diff(trip_offsets))
+
+        loc_keys, loc_codes = np.unique(loc_ids, return_inverse=True)
+
+        # Vertex keys (location, timestamp, is_departure) of all stop events
+
+        dep_events = np.flatnonzero(~is_last)
+        arr_events = np.flatnonzero(~is_first)
+
+        event_keys = np.concatenate((
+            np.column_stack((loc_codes[dep_events], dep_timestamps[dep_events], np.ones(len(dep_events), dtype=np.int64))),
+            np.column_stack((loc_codes[arr_events], arr_timestamps[arr_events], np.zeros(len(arr_events), dtype=np.int64)))))
+
+        vertex_keys, vertex_codes = np.unique(event_keys, axis=0, return_inverse=True)
+        vertex_codes = vertex_codes.reshape(-1)
+
+        # Reuse vertices which are already part of the graph
+
+        self.update_index()
+
+        loc_indices = np.array([self.g.gp.location_index[k] for k in loc_keys], dtype=np.int64)
+
+        vertex_locs = loc_indices[vertex_keys[:, 0]]
+        is_departure = vertex_keys[:, 2] == 1
+
+        vertices = np.where(is_departure,
+            self.g.gp.departure_index.find_many(vertex_locs, vertex_keys[:, 1]),
+            self.g.gp.arrival_index.find_many(vertex_locs, vertex_keys[:, 1]))
+
+        is_new = vertices < 0
+        num_vertices = self.g.num_vertices()
+        num_new_vertices = int(is_new.sum())
+
+        if num_new_vertices > 0:
+
+            vertices[is_new] = np.arange(num_vertices, num_vertices + num_new_vertices)
+
+            self.g.add_vertex(num_new_vertices)
+
+            self.g.vp.loc_id.a[num_vertices:] = vertex_locs[is_new]
+            self.g.vp.timestamp.a[num_vertices:] = vertex_keys[is_new, 1]
+            self.g.vp.is_departure.a[num_vertices:] = is_departure[is_new]
+
+            self.index_outdated = True
+
+        event_dep_vertices = np.full(num_events, -1, dtype=np.int64)
+        event_dep_vertices[dep_events] = vertices[vertex_codes[:len(dep_events)]]
+        event_arr_vertices = np.full(num_events, -1, dtype=np.int64)
+        event_arr_vertices[arr_events] = vertices[vertex_codes[len(dep_events):]]
+
+        # Edges in the same order as add_trip: at each stop the stationary
+        # edge comes before the edge to the next stop
+
+        stationary_events = np.flatnonzero(~is_first & ~is_last)
+        edge_events = np.concatenate((stationary_events, dep_events))
+        is_stationary = np.concatenate((np.ones(len(stationary_events), dtype=bool), np.zeros(len(dep_events), dtype=bool)))
+
+        order = np.argsort(2 * edge_events + ~is_stationary, kind='stable')
+        edge_events = edge_events[order]
+        is_stationary = is_stationary[order]
+
+        sources = np.where(is_stationary, event_arr_vertices[edge_events], event_dep_vertices[edge_events])
+        targets = np.where(is_stationary, event_dep_vertices[edge_events], event_arr_vertices[np.minimum(edge_events + 1, num_events - 1)])
+
+        timestamps = self.g.vp.timestamp.a
+        durations = timestamps[targets] - timestamps[sources]
+
+        is_transport = np.ones(len(edge_events), dtype=np.int64)
+
+        self.g.add_edge_list(np.column_stack((sources, targets, durations, is_transport, is_stationary,
+            event_trips[edge_events])), eprops=[self.g.ep.duration, self.g.ep.is_transport, self.g.ep.is_stationary,
+            self.g.ep.trip])
+
+        self.update_index()
+        self.reset_search_data()
+
+        return
+
+
+    def add_vertex(self, loc_id, datetime, is_departure=True):
+
+        timestamp = self.timestamp_from_datetime(datetime)
+
+        v = self.find_vertex(loc_id, timestamp, is_departure)
+
+        if v is not None:
+            return v
+
+        loc_index = self.g.gp.location_index[loc_id]
+
+        v = self.g.add_vertex()
+
+        self.g.vp.loc_id[v] = loc_index
+        self.g.vp.timestamp[v] = timestamp
+        self.g.vp.is_departure[v] = is_departure
+
+        self.new_vertices[(loc_index, timestamp, is_departure)] = v
+        self.index_outdated = True
+
+        return v
+
+
+    def find_vertex(self, loc_id, timestamp, is_departure=True):
+
+        loc_index = self.g.gp.location_index[loc_id]
+
+        v = self.new_vertices.get((loc_index, timestamp, is_departure))
+
+        if v is not None:
+            return v
+
+        index = self.g.gp.departure_index if is_departure else self.g.gp.arrival_index
+
+        if index is None:
+            return None
+
+        v = index.find(loc_index, timestamp)
+
+        if v is None:
+            return None
+
+        return self.g.vertex(v)
+
+
+    def update_index(self):
+
+        if not self.index_outdated:
+            return
+
+        with self.lock:
+            if self.index_outdated:
+                self.build_index()
+
+
+    def build_index(self):
+
+        # Vertices left without edges by update_trips are not indexed
+        vertices = np.flatnonzero(self.g.get_total_degrees(self.g.get_vertices()))
+
+        is_departure = self.g.vp.is_departure.a[vertices].astype(bool)
+        is_waiting = self.g.vp.is_waiting.a[vertices].astype(bool)
+        is_arrival = ~is_departure & ~is_waiting
+        loc_ids = self.g.vp.loc_id.a[vertices]
+        timestamps = self.g.vp.timestamp.a[vertices]
+
+        num_locations = len(self.g.gp.location_ids)
+
+        self.g.gp.departure_index = event_index(loc_ids[is_departure], timestamps[is_departure],
+            vertices[is_departure], num_locations)
+        self.g.gp.arrival_index = event_index(loc_ids[is_arrival], timestamps[is_arrival],
+            vertices[is_arrival], num_locations)
+        self.g.gp.waiting_index = event_index(loc_ids[is_waiting], timestamps[is_waiting],
+            vertices[is_waiting], num_locations)
+
+        # All vertices in timestamp order, as the events of a single location
+        self.g.gp.time_index = event_index(np.zeros(len(vertices), dtype=np.int64), timestamps, vertices, 1)
+
+        self.g.gp.location_grid = location_grid(self.g.gp.location_lats, self.g.gp.location_lons)
+
+        self.new_vertices = {}
+        self.index_outdated = False
+
+
+    def add_edge(self, v1, v2, is_transport=False, is_stationary=False, is_transfer=False, trip=-1):
+
+        e = self.g.add_edge(v1, v2)
+
+        self.reset_search_data()
+
+        self.g.ep.duration[e] = self.g.vp.timestamp[v2] - self.g.vp.timestamp[v1]
+        self.g.ep.is_transport[e] = is_transport
+        self.g.ep.is_stationary[e] = is_stationary
+        self.g.ep.is_transfer[e] = is_transfer
+        self.g.ep.trip[e] = trip
+
+        return e
+
+
+    def add_transfer(self, from_loc_id, to_loc_id, min_transfer_time, max_transfer_time):
+
+        self.add_transfers([from_loc_id], [to_loc_id], min_transfer_time, max_transfer_time)
+
+        return
+
+
+    def add_transfers(self, from_loc_ids, to_loc_ids, min_transfer_time, max_transfer_time):
+
+        # Links every arrival at a from location to the departures at the matching
+        # to location with arrival + min_transfer_time < departure < arrival + max_transfer_time.
+        # With waiting chains the arrival is linked to the waiting vertex of the first
+        # such departure only, max_transfer_time then only limits the wait for that
+        # first departure, later ones are reached along the chain.
+
+        self.update_index()
+
+        pairs = [(self.g.gp.location_index[f], self.g.gp.location_index[t]) for f, t in zip(from_loc_ids, to_loc_ids)
+            if f in self.g.gp.location_index and t in self.g.gp.location_index]
+
+        if len(pairs) == 0:
+            return 0
+
+        from_locs, to_locs = np.array(pairs, dtype=np.int64).T
+
+        rows = np.column_stack((from_locs, to_locs, np.full(len(pairs), int(min_transfer_time)),
+            np.full(len(pairs), int(max_transfer_time))))
+
+        self.g.gp.transfers = np.concatenate((self.g.gp.transfers, rows))
+
+        if self.g.gp.waiting_chains and len(self.g.gp.waiting_index.vertices) == 0:
+            self.add_waiting_chains()
+
+        arrivals = self.g.gp.arrival_index
+
+        # One row per transfer pair and arrival at its from location
+        pair_rows, arr_positions = expand_ranges(arrivals.offsets[from_locs], arrivals.offsets[from_locs + 1])
+
+        sources, targets, durations = self.transfer_edges(arrivals.vertices[arr_positions],
+            arrivals.timestamps[arr_positions], rows[pair_rows])
+
+        self.g.add_edge_list(np.column_stack((sources, targets, durations, np.ones(len(sources), dtype=np.int64),
+            np.full(len(sources), -1))), eprops=[self.g.ep.duration, self.g.ep.is_transfer, self.g.ep.trip])
+
+        self.reset_search_data()
+
+        return len(sources)
+
+
+    def transfer_edges(self, arr_vertices, arr_timestamps, rows):
+
+        # Transfer edges from arrival vertices, each paired with a transfer row of
+        # its location. Without waiting chains they lead to the departures at the
+        # row's to location with arrival + min < departure < arrival + max, with
+        # waiting chains to the waiting vertex of the first such departure.
+
+        arr_timestamps = np.asarray(arr_timestamps, dtype=np.int64)
+        to_locs = rows[:, 1]
+
+        if self.g.gp.waiting_chains:
+
+            waiting = self.g.gp.waiting_index
+
+            first = np.searchsorted(waiting.keys(), waiting.keys(to_locs, arr_timestamps + rows[:, 2]), side='right')
+
+            is_reachable = first < waiting.offsets[to_locs + 1]
+            is_reachable[is_reachable] = (waiting.timestamps[first[is_reachable]]
+                < arr_timestamps[is_reachable] + rows[is_reachable, 3])
+
+            return (np.asarray(arr_vertices)[is_reachable], waiting.vertices[first[is_reachable]],
+                waiting.timestamps[first[is_reachable]] - arr_timestamps[is_reachable])
+
+        departures = self.g.gp.departure_index
+
+        # Departure window of each row, searched on the (location, timestamp) keys of all departures
+        dep_keys = departures.keys()
+        first = np.searchsorted(dep_keys, departures.keys(to_locs, arr_timestamps + rows[:, 2]), side='right')
+        last = np.searchsorted(dep_keys, departures.keys(to_locs, arr_timestamps + rows[:, 3]), side='left')
+
+        arr_rows, dep_positions = expand_ranges(first, np.maximum(first, last))
+
+        return (np.asarray(arr_vertices)[arr_rows], departures.vertices[dep_positions],
+            departures.timestamps[dep_positions] - arr_timestamps[arr_rows])
+
+
+    def transfer_edges_to_departures(self, dep_vertices, dep_timestamps, rows):
+
+        # Transfer edges to departure vertices, each paired with a transfer row to
+        # its location, from the arrivals at the row's from location with
+        # arrival + min < departure < arrival + max. Not used with waiting chains.
+
+        dep_timestamps = np.asarray(dep_timestamps, dtype=np.int64)
+        from_locs = rows[:, 0]
+
+        arrivals = self.g.gp.arrival_index
+
+        arr_keys = arrivals.keys()
+        first = np.searchsorted(arr_keys, arrivals.keys(from_locs, dep_timestamps - rows[:, 3]), side='right')
+        last = np.searchsorted(arr_keys, arrivals.keys(from_locs, dep_timestamps - rows[:, 2]), side='left')
+
+        dep_rows, arr_positions = expand_ranges(first, np.maximum(first, last))
+
+        return (arrivals.vertices[arr_positions], np.asarray(dep_vertices)[dep_rows],
+            dep_timestamps[dep_rows] - arrivals.timestamps[arr_positions])
+
+
+    def transfer_rows(self, loc_ids, column):
+
+        # Transfer rows whose from (column 0) or to (column 1) location is one of
+        # loc_ids, as (position in loc_ids, row)
+
+        transfers = self.g.gp.transfers
+        order = np.argsort(transfers[:, column], kind='stable')
+
+        offsets = np.zeros(len(self.g.gp.location_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(transfers[:, column], minlength=len(self.g.gp.location_ids)), out=offsets[1:])
+
+        loc_ids = np.asarray(loc_ids, dtype=np.int64)
+        positions, row_positions = expand_ranges(offsets[loc_ids], offsets[loc_ids + 1])
+
+        return positions, transfers[order[row_positions]]
+
+
+    def add_waiting_chains(self, loc_ids=None):
+
+        # Adds a waiting vertex for every departure vertex. Waiting vertices of a
+        # location are chained in time order, each one can board its departure
+        # or wait for the next one. Chains are built once after all trips, or
+        # for loc_ids only after their departures changed. Returns the new
+        # waiting vertices.
+
+        self.update_index()
+
+        departures = self.g.gp.departure_index
+
+        if loc_ids is None:
+            positions = np.arange(len(departures.vertices))
+        else:
+            _, positions = expand_ranges(departures.offsets[loc_ids], departures.offsets[np.asarray(loc_ids) + 1])
+
+        num_waiting = len(positions)
+
+        if num_waiting == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        waiting_vertices = self.allocate_vertices(num_waiting)
+        loc_ids = np.repeat(np.arange(len(departures.offsets) - 1), np.diff(departures.offsets))[positions]
+        timestamps = departures.timestamps[positions]
+
+        self.g.vp.loc_id.a[waiting_vertices] = loc_ids
+        self.g.vp.timestamp.a[waiting_vertices] = timestamps
+        self.g.vp.is_waiting.a[waiting_vertices] = True
+
+        chained = np.flatnonzero(loc_ids[:-1] == loc_ids[1:])
+
+        sources = np.concatenate((waiting_vertices, waiting_vertices[chained]))
+        targets = np.concatenate((departures.vertices[positions], waiting_vertices[chained + 1]))
+        durations = np.concatenate((np.zeros(num_waiting, dtype=np.int64),
+            np.diff(timestamps.astype(np.int64))[chained]))
+
+        self.g.add_edge_list(np.column_stack((sources, targets, durations, np.ones(len(sources), dtype=np.int64),
+            np.full(len(sources), -1))), eprops=[self.g.ep.duration, self.g.ep.is_waiting, self.g.ep.trip])
+
+        self.g.gp.waiting_index = self.g.gp.waiting_index.updated([], loc_ids, timestamps, waiting_vertices,
+            len(self.g.gp.location_ids))
+        self.g.gp.time_index = self.g.gp.time_index.updated([], np.zeros(num_waiting, dtype=np.int64), timestamps,
+            waiting_vertices, 1)
+
+        self.reset_search_data()
+
+        return waiting_vertices
+
+
+    def allocate_vertices(self, num):
+
+        # Ids of num vertices for new events, free vertices first. Returns them in
+        # ascending order.
+
+        free = self.g.gp.free_vertices
+        self.g.gp.free_vertices = free[num:]
+
+        num_vertices = self.g.num_vertices()
+        num_added = num - len(free[:num])
+
+        if num_added > 0:
+            self.g.add_vertex(num_added)
+
+        return np.concatenate((free[:num], np.arange(num_vertices, num_vertices + num_added))).astype(np.int64)
+
+
+    def free_vertices(self, vertices):
+
+        # Makes vertices without edges available to allocate_vertices. Freed
+        # vertices must not inherit old values when they are reused.
+
+        for prop in self.g.vp.values():
+            prop.a[vertices] = 0
+
+        self.g.gp.free_vertices = np.union1d(self.g.gp.free_vertices, vertices).astype(np.int64)
+
+
+    def transport_edges(self):
+
+        # Transport edges as rows of (source, target, edge index, trip), sorted by trip
+
+        edges = self.g.get_edges([self.g.edge_index, self.g.ep.is_transport, self.g.ep.trip])
+        edges = edges[edges[:, 3] == 1][:, [0, 1, 2, 4]]
+
+        return edges[np.argsort(edges[:, 3], kind='stable')]
+
+
+    def trip_vertex_sequences(self, trips, edges):
+
+        # Vertices of the given trips (interned indices) in travel order, departure,
+        # arrival, departure, ..., arrival, and the edge indices between them.
+        # edges are the rows of transport_edges.
+
+        timestamps = self.g.vp.timestamp.a
+
+        first = np.searchsorted(edges[:, 3], trips, side='left')
+        last = np.searchsorted(edges[:, 3], trips, side='right')
+
+        sequences = {}
+
+        for trip, trip_edges in zip(trips, (edges[f:l] for f, l in zip(first.tolist(), last.tolist()))):
+
+            next_edges = {source: i for i, source in enumerate(trip_edges[:, 0].tolist())}
+            starts = set(next_edges) - set(trip_edges[:, 1].tolist())
+
+            if len(starts) == 0:
+                sequences[trip] = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+                continue
+
+            v = min(starts, key=lambda start: timestamps[start])
+            vertices = [v]
+            edge_indices = []
+
+            while v in next_edges:
+                i = next_edges.pop(v)
+                v = int(trip_edges[i, 1])
+                vertices.append(v)
+                edge_indices.append(int(trip_edges[i, 2]))
+
+            sequences[trip] = (np.array(vertices, dtype=np.int64), np.array(edge_indices, dtype=np.int64))
+
+        return sequences
+
+
+    def trip_stop_events(self, trip_ids):
+
+        # Stops of the given trips as (location indices, arrival timestamps, departure
+        # timestamps) per trip id, the arrival at the first and the departure at the
+        # last stop are set to the departure and arrival there. Unknown trips are left out.
+
+        trips = [self.g.gp.trip_index[trip_id] for trip_id in trip_ids if trip_id in self.g.gp.trip_index]
+        sequences = self.trip_vertex_sequences(np.array(trips, dtype=np.int64), self.transport_edges())
+
+        timestamps = self.g.vp.timestamp.a
+        loc_ids = self.g.vp.loc_id.a
+
+        events = {}
+
+        for trip, (vertices, _) in sequences.items():
+
+            if len(vertices) == 0:
+                continue
+
+            # Departure vertices at even, arrival vertices at odd positions
+            departures = np.append(vertices[0::2], vertices[-1])
+            arrivals = np.insert(vertices[1::2], 0, vertices[0])
+
+            events[self.g.gp.trip_ids[trip]] = (loc_ids[departures].astype(np.int64),
+                timestamps[arrivals].astype(np.int64), timestamps[departures].astype(np.int64))
+
+        return events
+
+
+    def update_trips(self, trip_ids, arr_timestamps, dep_timestamps):
+
+        # Reschedules trips without rebuilding the graph. arr_timestamps[k] and
+        # dep_timestamps[k] hold the new times at all stops of trip_ids[k] (as
+        # returned by trip_stop_events), None cancels the trip. Vertices only used
+        # by an updated trip are shifted in place, shared ones are left to the
+        # other trips. Only the transfer and waiting edges of shifted, new and
+        # removed vertices are rebuilt, and the indexes are merged rather than
+        # sorted again. Raises ValueError, before changing the graph, if the times
+        # of a trip do not match its stops. Returns the number of updated trips.
+
+        self.update_index()
+
+        updates = {self.g.gp.trip_index[trip_id]: (arr, dep) for trip_id, arr, dep
+            in zip(trip_ids, arr_timestamps, dep_timestamps) if trip_id in self.g.gp.trip_index}
+
+        edges = self.transport_edges()
+        sequences = self.trip_vertex_sequences(np.array(list(updates), dtype=np.int64), edges)
+
+        # Checked before any edge is removed, an invalid update would cancel its trip
+        for trip, (arr, dep) in updates.items():
+
+            vertices, _ = sequences[trip]
+
+            if arr is not None and len(vertices) > 0 and (len(arr) != len(vertices) // 2 + 1 or len(dep) != len(arr)):
+                raise ValueError('Update of trip {} has {} arrival and {} departure times for {} stops'.format(
+                    self.g.gp.trip_ids[trip], len(arr), len(dep), len(vertices) // 2 + 1))
+
+        num_vertices = self.g.num_vertices()
+        timestamps = self.g.vp.timestamp.a
+        loc_ids = self.g.vp.loc_id.a
+        is_departure = self.g.vp.is_departure.a
+
+        # Transport degree of every vertex once the edges of the updated trips are removed
+        degrees = np.bincount(edges[:, :2].reshape(-1), minlength=num_vertices)
+
+        for vertices, _ in sequences.values():
+            np.subtract.at(degrees, vertices[:-1], 1)
+            np.subtract.at(degrees, vertices[1:], 1)
+
+        departures = self.g.gp.departure_index
+        arrivals = self.g.gp.arrival_index
+
+        placed = {}
+        used = set()
+        moved = set()
+        new_keys = []
+        new_edges = []
+        num_updated = 0
+
+        for trip, (arr, dep) in updates.items():
+
+            vertices, _ = sequences[trip]
+
+            if len(vertices) == 0:
+                continue
+
+            if arr is None:
+                num_updated += 1
+                continue
+
+            new_timestamps = np.empty(len(vertices), dtype=np.int64)
+            new_timestamps[0::2] = np.asarray(dep, dtype=np.int64)[:-1]
+            new_timestamps[1::2] = np.asarray(arr, dtype=np.int64)[1:]
+            new_timestamps = np.maximum.accumulate(new_timestamps)
+
+            trip_vertices = []
+
+            for v, timestamp in zip(vertices.tolist(), new_timestamps.tolist()):
+
+                key = (int(loc_ids[v]), timestamp, bool(is_departure[v]))
+
+                if key not in placed:
+
+                    existing = (departures if key[2] else arrivals).find(key[0], timestamp)
+
+                    if timestamp == timestamps[v] and v not in moved:
+                        placed[key] = v
+                    elif existing is not None and existing not in moved:
+                        placed[key] = int(existing)
+                    elif degrees[v] == 0 and v not in moved and v not in used:
+                        timestamps[v] = timestamp
+                        moved.add(v)
+                        placed[key] = v
+                    else:
+                        placed[key] = num_vertices + len(new_keys)
+                        new_keys.append(key)
+
+                    used.add(placed[key])
+
+                trip_vertices.append(placed[key])
+
+            trip_vertices = np.array(trip_vertices, dtype=np.int64)
+
+            is_stationary = np.arange(len(trip_vertices) - 1) % 2 == 1
+
+            new_edges.append(np.column_stack((trip_vertices[:-1], trip_vertices[1:], is_stationary,
+                np.full(len(is_stationary), trip))))
+
+            num_updated += 1
+
+        new_edges = np.concatenate(new_edges) if new_edges else np.zeros((0, 4), dtype=np.int64)
+
+        # New events were numbered from num_vertices on, they get free or added vertices
+        new_vertices = self.allocate_vertices(len(new_keys))
+
+        if len(new_keys) > 0:
+
+            new_keys = np.array(new_keys, dtype=np.int64)
+
+            self.g.vp.loc_id.a[new_vertices] = new_keys[:, 0]
+            self.g.vp.timestamp.a[new_vertices] = new_keys[:, 1]
+            self.g.vp.is_departure.a[new_vertices] = new_keys[:, 2]
+
+            is_new = new_edges[:, :2] >= num_vertices
+            new_edges[:, :2][is_new] = new_vertices[new_edges[:, :2][is_new] - num_vertices]
+
+        total_vertices = self.g.num_vertices()
+        timestamps = self.g.vp.timestamp.a
+        loc_ids = self.g.vp.loc_id.a
+        is_departure = self.g.vp.is_departure.a.astype(bool)
+
+        # Vertices of the old schedules no trip stops at anymore
+        degrees = np.concatenate((degrees, np.zeros(total_vertices - num_vertices, dtype=np.int64)))
+        degrees += np.bincount(new_edges[:, :2].reshape(-1), minlength=total_vertices)
+
+        old_vertices = np.unique(np.concatenate([vertices for vertices, _ in sequences.values()] + [new_vertices[:0]]))
+        orphans = old_vertices[degrees[old_vertices] == 0]
+
+        moved = np.array(sorted(moved), dtype=np.int64)
+        changed = np.concatenate((moved, new_vertices))
+        removed = np.concatenate((moved, orphans))
+
+        # Waiting chains are rebuilt at every location whose departures changed
+        touched = np.concatenate((changed, orphans))
+        chain_locs = np.unique(loc_ids[touched[is_departure[touched]]]).astype(np.int64)
+
+        if self.g.gp.waiting_chains:
+            waiting = self.g.gp.waiting_index
+            _, positions = expand_ranges(waiting.offsets[chain_locs], waiting.offsets[chain_locs + 1])
+            old_waiting = waiting.vertices[positions]
+        else:
+            old_waiting = np.zeros(0, dtype=np.int64)
+
+        # Removes the old trip edges and all other edges of moved, orphaned and
+        # replaced waiting vertices
+
+        is_removed = np.zeros(total_vertices, dtype=bool)
+        is_removed[removed] = True
+        is_removed[old_waiting] = True
+
+        all_edges = self.g.get_edges([self.g.edge_index, self.g.ep.is_transport])
+
+        removed_edges = np.concatenate([edge_indices for _, edge_indices in sequences.values()]
+            + [all_edges[(all_edges[:, 3] == 0) & (is_removed[all_edges[:, 0]] | is_removed[all_edges[:, 1]]), 2]])
+
+        # Freed edge indices are reused by new edges, which must not inherit old values
+        for prop in self.g.ep.values():
+            prop.a[removed_edges] = 0
+
+        keep = self.g.new_edge_property('bool', val=True)
+        keep.a[removed_edges] = False
+
+        self.g.set_edge_filter(keep)
+        self.g.purge_edges()
+        self.g.clear_filters()
+
+        # Orphaned and replaced waiting vertices have no edges left and are reused
+        # by the new waiting chains and later updates
+        self.free_vertices(np.concatenate((orphans, old_waiting)))
+
+        durations = timestamps[new_edges[:, 1]] - timestamps[new_edges[:, 0]]
+
+        self.g.add_edge_list(np.column_stack((new_edges[:, :2], durations, np.ones(len(new_edges), dtype=np.int64),
+            new_edges[:, 2:])), eprops=[self.g.ep.duration, self.g.ep.is_transport, self.g.ep.is_stationary,
+            self.g.ep.trip])
+
+        num_locations = len(self.g.gp.location_ids)
+
+        changed_departures = changed[is_departure[changed]]
+        changed_arrivals = changed[~is_departure[changed]]
+
+        self.g.gp.departure_index = self.g.gp.departure_index.updated(removed, loc_ids[changed_departures],
+            timestamps[changed_departures], changed_departures, num_locations)
+        self.g.gp.arrival_index = self.g.gp.arrival_index.updated(removed, loc_ids[changed_arrivals],
+            timestamps[changed_arrivals], changed_arrivals, num_locations)
+        self.g.gp.waiting_index = self.g.gp.waiting_index.updated(old_waiting, [], [], [], num_locations)
+        self.g.gp.time_index = self.g.gp.time_index.updated(np.concatenate((removed, old_waiting)),
+            np.zeros(len(changed), dtype=np.int64), timestamps[changed], changed, 1)
+
+        # Transfer edges of the changed vertices, each one added once
+        arrivals = self.g.gp.arrival_index
+
+        if self.g.gp.waiting_chains:
+
+            self.add_waiting_chains(chain_locs)
+
+            # From all arrivals to the new chains, and from changed arrivals to the other chains
+            _, rows = self.transfer_rows(chain_locs, 1)
+            pair_rows, arr_positions = expand_ranges(arrivals.offsets[rows[:, 0]], arrivals.offsets[rows[:, 0] + 1])
+            transfers = [self.transfer_edges(arrivals.vertices[arr_positions], arrivals.timestamps[arr_positions],
+                rows[pair_rows])]
+
+            positions, rows = self.transfer_rows(loc_ids[changed_arrivals], 0)
+            is_other = ~np.isin(rows[:, 1], chain_locs)
+            transfers.append(self.transfer_edges(changed_arrivals[positions[is_other]],
+                timestamps[changed_arrivals[positions[is_other]]], rows[is_other]))
+
+        else:
+
+            # From changed arrivals to all departures, and from the other arrivals to changed departures
+            positions, rows = self.transfer_rows(loc_ids[changed_arrivals], 0)
+            transfers = [self.transfer_edges(changed_arrivals[positions], timestamps[changed_arrivals[positions]], rows)]
+
+            positions, rows = self.transfer_rows(loc_ids[changed_departures], 1)
+            sources, targets, transfer_durations = self.transfer_edges_to_departures(changed_departures[positions],
+                timestamps[changed_departures[positions]], rows)
+            is_other = ~np.isin(sources, changed_arrivals)
+            transfers.append((sources[is_other], targets[is_other], transfer_durations[is_other]))
+
+        sources, targets, transfer_durations = (np.concatenate(columns) for columns in zip(*transfers))
+
+        self.g.add_edge_list(np.column_stack((sources, targets, transfer_durations,
+            np.ones(len(sources), dtype=np.int64), np.full(len(sources), -1))),
+            eprops=[self.g.ep.duration, self.g.ep.is_transfer, self.g.ep.trip])
+
+        self.reset_search_data()
+
+        return num_updated
+
+
+    def apply_trip_updates(self, trip_updates, timezone=None):
+
+        # Applies GTFS-Realtime trip updates as read by gtfs_realtime.read_trip_updates.
+        # Stops are matched by stop id, the delay of a stop holds for the following
+        # stops until the next update. Delays are rounded to minutes, trips not in
+        # the graph are skipped. Stops with a real-time time but no delay are
+        # converted with timezone, the agency_timezone of the feed (see
+        # gtfs_parser.get_timezone). Returns the number of updated trips.
+
+        events = self.trip_stop_events([trip_update['trip_id'] for trip_update in trip_updates])
+
+        trip_ids = []
+        arr_timestamps = []
+        dep_timestamps = []
+
+        for trip_update in trip_updates:
+
+            if trip_update['trip_id'] not in events:
+                continue
+
+            trip_ids.append(trip_update['trip_id'])
+
+            if trip_update['canceled']:
+                arr_timestamps.append(None)
+                dep_timestamps.append(None)
+                continue
+
+            loc_ids, arr, dep = events[trip_update['trip_id']]
+            stop_ids = [str(self.g.gp.location_ids[loc_id]) for loc_id in loc_ids.tolist()]
+
+            # Arrival and departure delay at every stop, in seconds
+            delays = np.zeros((len(stop_ids), 2))
+            position = 0
+
+            for stop_update in trip_update['stop_time_updates']:
+
+                if str(stop_update['stop_id']) not in stop_ids[position:]:
+                    continue
+
+                i = stop_ids.index(str(stop_update['stop_id']), position)
+
+                arr_delay = self.stop_delay(stop_update['arrival_delay'], stop_update['arrival_time'], arr[i], timezone)
+                dep_delay = self.stop_delay(stop_update['departure_delay'], stop_update['departure_time'], dep[i], timezone)
+
+                arr_delay = dep_delay if arr_delay is None else arr_delay
+                dep_delay = arr_delay if dep_delay is None else dep_delay
+
+                if arr_delay is None:
+                    continue
+
+                delays[i] = (arr_delay, dep_delay)
+                delays[i + 1:] = dep_delay
+                position = i
+
+            delays = np.round(delays / 60).astype(np.int64)
+
+            arr_timestamps.append(arr + delays[:, 0])
+            dep_timestamps.append(dep + delays[:, 1])
+
+        return self.update_trips(trip_ids, arr_timestamps, dep_timestamps)
+
+
+    def apply_trip_update_file(self, filename, timezone=None):
+
+        # Applies the trip updates of a GTFS-Realtime protobuf or JSON file
+
+        return self.apply_trip_updates(read_trip_updates(filename), timezone)
+
+
+    def stop_delay(self, delay, datetime, timestamp, timezone=None):
+
+        # Delay in seconds, from the given delay or the difference of the
+        # real-time datetime to the scheduled timestamp. Real-time datetimes are
+        # absolute and need the timezone of the feed (see local_datetime).
+
+        if delay is not None:
+            return delay
 
-        self.g = Graph()
+        if datetime is None:
+            return None
 
-        self.g.gp.begin = self.g.new_graph_property('object')
-        self.g.gp.begin = begin
+        if datetime.tzinfo is not None:
+            if timezone is None:
+                raise ValueError('Trip updates with real-time times but no delays need the timezone of the feed')
+            datetime = local_datetime(datetime, timezone)
 
-        self.g.gp.end = self.g.new_graph_property('object')
-        self.g.gp.end = end
+        if self.timestamp_from_datetime(datetime) is None:
+            return None
 
-        self.g.gp.locations = self.g.new_graph_property('object')
-        self.g.gp.locations = {}
+        return (self.timestamp_from_datetime(datetime) - int(timestamp)) * 60
 
-        self.g.gp.departure_vertices = self.g.new_graph_property('object')
-        self.g.gp.departure_vertices = {}
 
-        self.g.gp.arrival_vertices = self.g.new_graph_property('object')
-        self.g.gp.arrival_vertices = {}
+    def reset_search_data(self):
 
-        self.g.gp.trips = self.g.new_graph_property('object')
-        self.g.gp.trips = {}
+        # Search structures derived from the graph, rebuilt on the next query
+        self.adjacency = None
+        self.connections = None
+        self.connection_scan = None
+        self.raptor = None
+        self.transport_edge_keys = None
 
-        self.g.vp.loc_id = self.g.new_vertex_property('int')
-        self.g.vp.timestamp = self.g.new_vertex_property('int')
-        self.g.vp.pos = self.g.new_vertex_property('vector<double>')
-        self.g.vp.is_departure = self.g.new_vertex_property('bool')
+        if self.query_cache is not None:
+            self.query_cache.clear()
 
-        self.g.ep.duration = self.g.new_edge_property('int')
-        self.g.ep.is_transport = self.g.new_edge_property('bool')
-        self.g.ep.is_stationary = self.g.new_edge_property('bool')
-        self.g.ep.is_transfer = self.g.new_edge_property('bool')
-        self.g.ep.trip_id = self.g.new_edge_property('string')
-        self.g.ep.loc_id = self.g.new_edge_property('string')
 
+    def get_connections(self):
 
-    def add_location(self, loc_id, name, latitude, longitude):
+        # Ride edges of all trips as connections, grouped by trip in travel order.
+        # Trips are numbered densely over the trips with rides.
 
-        self.g.gp.locations[loc_id] = {
-            'name': name, 
-            'lat': latitude, 
-            'lon': longitude
-            }
+        if self.connections is None:
+            with self.lock:
+                if self.connections is None:
 
-        self.g.gp.departure_vertices[loc_id] = {}
-        self.g.gp.arrival_vertices[loc_id] = {}
+                    edges = self.g.get_edges([self.g.edge_index, self.g.ep.is_transport, self.g.ep.is_stationary,
+                        self.g.ep.trip])
+                    rides = edges[(edges[:, 3] == 1) & (edges[:, 4] == 0)]
 
+                    timestamps = self.g.vp.timestamp.a
+                    loc_ids = self.g.vp.loc_id.a
 
-    def add_trip(self, loc_ids, dep_times, arr_times, trip_id, trip_name):
+                    rides = rides[np.lexsort((rides[:, 2], timestamps[rides[:, 1]], timestamps[rides[:, 0]], rides[:, 5]))]
 
-        self.g.gp.trips[trip_id] = { 
-            'name': trip_name,
-            'origin_loc_id': loc_ids[0],
-            'destination_loc_id': loc_ids[-1]
-            }
+                    self.connections = {
+                        'dep_vertices': rides[:, 0],
+                        'arr_vertices': rides[:, 1],
+                        'dep_locs': loc_ids[rides[:, 0]],
+                        'arr_locs': loc_ids[rides[:, 1]],
+                        'dep_timestamps': timestamps[rides[:, 0]],
+                        'arr_timestamps': timestamps[rides[:, 1]],
+                        'trips': np.unique(rides[:, 5], return_inverse=True)[1].reshape(-1)
+                        }
 
-        current_vertex = self.add_vertex(loc_ids[0], dep_times[0])
+        return self.connections
 
-        for i in range(len(loc_ids) - 2):
 
-            arrival_vertex = self.add_vertex(loc_ids[i+1], arr_times[i], is_departure=False)
+    def get_connection_scan(self):
 
-            self.add_edge(current_vertex, arrival_vertex, is_transport=True, trip_id=trip_id)
+        if self.connection_scan is None:
+            connections = self.get_connections()
+            with self.lock:
+                if self.connection_scan is None:
+                    self.connection_scan = connection_scan(connections['dep_locs'], connections['arr_locs'],
+                        connections['dep_timestamps'], connections['arr_timestamps'], connections['trips'],
+                        self.g.gp.transfers[:, :3], len(self.g.gp.location_ids))
 
-            current_vertex = arrival_vertex
+        return self.connection_scan
 
-            departure_vertex = self.add_vertex(loc_ids[i+1], dep_times[i+1])
 
-            self.add_edge(current_vertex, departure_vertex, is_transport=True, is_stationary=True,
-                trip_id=trip_id, loc_id=loc_ids[i+1])
+    def get_raptor(self):
 
-            current_vertex = departure_vertex
+        # Stop events per trip for the RAPTOR route patterns, taken from the
+        # connections: a trip with n connections has n + 1 stop events
 
-        
-        destination_vertex = self.add_vertex(loc_ids[-1], arr_times[-1], is_departure=False)
+        if self.raptor is None:
+            connections = self.get_connections()
+            with self.lock:
+                if self.raptor is None:
 
-        self.add_edge(current_vertex, destination_vertex, is_transport=True, trip_id=trip_id)
+                    trips = connections['trips']
+                    num_trips = int(trips[-1]) + 1 if len(trips) > 0 else 0
 
-        return
+                    connection_offsets = np.zeros(num_trips + 1, dtype=np.int64)
+                    np.cumsum(np.bincount(trips, minlength=num_trips), out=connection_offsets[1:])
+                    trip_offsets = connection_offsets + np.arange(num_trips + 1)
 
+                    is_first = np.zeros(trip_offsets[-1], dtype=bool)
+                    is_first[trip_offsets[:-1]] = True
+                    is_last = np.zeros(trip_offsets[-1], dtype=bool)
+                    is_last[trip_offsets[1:] - 1] = True
 
-    def add_vertex(self, loc_id, datetime, is_departure=True):
+                    loc_ids = np.empty(trip_offsets[-1], dtype=np.int64)
+                    loc_ids[is_first] = connections['dep_locs'][connection_offsets[:-1]]
+                    loc_ids[~is_first] = connections['arr_locs']
 
-        timestamp = self.timestamp_from_datetime(datetime)
+                    arr_timestamps = np.empty(trip_offsets[-1], dtype=np.int64)
+                    arr_timestamps[is_first] = connections['dep_timestamps'][connection_offsets[:-1]]
+                    arr_timestamps[~is_first] = connections['arr_timestamps']
 
-        v = None
+                    dep_timestamps = np.empty(trip_offsets[-1], dtype=np.int64)
+                    dep_timestamps[is_last] = connections['arr_timestamps'][connection_offsets[1:] - 1]
+                    dep_timestamps[~is_last] = connections['dep_timestamps']
 
-        if is_departure:
-            if timestamp in self.g.gp.departure_vertices[loc_id]:
-                return self.g.gp.departure_vertices[loc_id][timestamp]
-        else:
-            if timestamp in self.g.gp.arrival_vertices[loc_id]:
-                return self.g.gp.arrival_vertices[loc_id][timestamp]
+                    self.raptor = raptor(trip_offsets, loc_ids, arr_timestamps, dep_timestamps,
+                        self.g.gp.transfers[:, :3], len(self.g.gp.location_ids))
 
+        return self.raptor
 
-        v = self.g.add_vertex()
 
-        self.g.vp.loc_id[v] = loc_id
-        self.g.vp.timestamp[v] = timestamp
-        self.g.vp.pos[v] = (self.g.gp.locations[loc_id]['lon'], self.g.gp.locations[loc_id]['lat'])
-        self.g.vp.is_departure[v] = is_departure
+    def get_transport_edge_keys(self):
 
-        if is_departure:
-            self.g.gp.departure_vertices[loc_id][timestamp] = v
-        else:
-            self.g.gp.arrival_vertices[loc_id][timestamp] = v
+        # Transport edges sorted by (source, target) keys with their trips, to look
+        # up the trips of many vertex pairs at once
 
-        return v
+        if self.transport_edge_keys is None:
+            with self.lock:
+                if self.transport_edge_keys is None:
 
+                    edges = self.transport_edges()
+                    keys = (edges[:, 0] << 32) + edges[:, 1]
+                    order = np.lexsort((edges[:, 3], keys))
 
-    def add_edge(self, v1, v2, is_transport=False, is_stationary=False, is_transfer=False, trip_id = None, loc_id = None):
+                    self.transport_edge_keys = {'keys': keys[order], 'trips': edges[order, 3]}
 
-        e = self.g.add_edge(v1, v2)
+        return self.transport_edge_keys
 
-        self.g.ep.duration[e] = self.g.vp.timestamp[v2] - self.g.vp.timestamp[v1]
-        self.g.ep.is_transport[e] = is_transport
-        self.g.ep.is_stationary[e] = is_stationary
-        self.g.ep.is_transfer[e] = is_transfer
-        self.g.ep.trip_id[e] = trip_id
-        self.g.ep.loc_id[e] = loc_id
 
-        return e
+    def pair_trips(self, sources, targets, pair_paths=None):
 
+        # Trip of the transport edge between each pair of consecutive path vertices,
+        # -1 for other pairs. Where trips share the vertices of an edge, the trip of
+        # the next or previous pair in the same path is taken.
 
-    def add_transfer(self, from_loc_id, to_loc_id, min_transfer_time, max_transfer_time):
-        
-        for arr_timestamp, arr_vertice in self.g.gp.arrival_vertices[from_loc_id].items():
-            for dep_timestamp, dep_vertice in self.g.gp.departure_vertices[to_loc_id].items():
+        edge_keys = self.get_transport_edge_keys()
 
-                    if dep_timestamp > arr_timestamp + min_transfer_time:
-                        if dep_timestamp < arr_timestamp + max_transfer_time:
+        if len(edge_keys['keys']) == 0:
+            return np.full(len(sources), -1, dtype=np.int64)
 
-                            self.add_edge(arr_vertice, dep_vertice, is_transfer=True)
+        if pair_paths is None:
+            pair_paths = np.zeros(len(sources), dtype=np.int64)
 
-        return
+        keys = (np.asarray(sources, dtype=np.int64) << 32) + np.asarray(targets, dtype=np.int64)
+        first = np.searchsorted(edge_keys['keys'], keys, side='left')
+        last = np.searchsorted(edge_keys['keys'], keys, side='right')
+
+        trips = np.where(last > first, edge_keys['trips'][np.minimum(first, len(edge_keys['keys']) - 1)], -1)
+
+        shared = np.flatnonzero(last - first > 1).tolist()
+
+        # Shared edges take the trip of the next pair, then of the previous one
+        for i, j in [(i, i + 1) for i in shared[::-1]] + [(i, i - 1) for i in shared]:
+            if 0 <= j < len(trips) and pair_paths[j] == pair_paths[i] and trips[j] >= 0 \
+                and trips[j] in edge_keys['trips'][first[i]:last[i]]:
+                trips[i] = trips[j]
+
+        return trips
+
+
+    def get_adjacency(self):
+
+        if self.adjacency is None:
+            with self.lock:
+                if self.adjacency is None:
+                    self.adjacency = adjacency(self.g)
 
+        return self.adjacency
 
 
     def timestamp_from_iso_str(self, iso_str):
@@ -157,206 +1629,675 @@ class timetable_graph:
             return int((datetime - self.g.gp.begin).total_seconds() / 60)
 
 
+    def departure_timestamp(self, dep_time):
+
+        # Timestamp of a departure time of a query, which must not be before begin
+
+        if dep_time < self.g.gp.begin:
+            raise ValueError('Departure time {} is before the begin {} of the timetable'.format(dep_time,
+                self.g.gp.begin))
+
+        return self.timestamp_from_datetime(dep_time)
+
+
     def datetime_from_timestamp(self, timestamp):
         
-        return self.g.gp.begin + dt.timedelta(minutes=timestamp)
+        return self.g.gp.begin + dt.timedelta(minutes=int(timestamp))
+
+
+    # Graph properties stored with pickle, all others are saved as arrays
+    saved_objects = ['begin', 'end', 'waiting_chains']
+
+    # Id and name tables, saved as arrays unless they mix types. The location and
+    # trip index dicts are rebuilt from the ids.
+    saved_tables = ['location_ids', 'location_names', 'trip_ids', 'trip_names']
 
+    # Index objects saved as their array attributes
+    saved_indexes = {'departure_index': event_index, 'arrival_index': event_index, 'waiting_index': event_index,
+        'time_index': event_index, 'location_grid': location_grid}
 
     def save_to_file(self, filename):
-        
-        # Vertex objects cannot be pickled, thus convert to int:
-        for loc_id, timestamps in self.g.gp.departure_vertices.items():
-            for t, v in timestamps.items():
-                self.g.gp.departure_vertices[loc_id][t] = int(v)
 
-        for loc_id, timestamps in self.g.gp.arrival_vertices.items():
-            for t, v in timestamps.items():
-                self.g.gp.arrival_vertices[loc_id][t] = int(v)
+        # Saves the graph into the directory filename: topology, vertex and edge
+        # properties, id and name tables, indexes and search data as .npy files,
+        # the remaining graph properties in meta.pkl. The graph is left unchanged.
+
+        self.update_index()
+        self.get_name_index()
+
+        os.makedirs(filename, exist_ok=True)
+
+        edges = self.g.get_edges([self.g.edge_index])
+
+        arrays = {'edges': edges[:, :2], 'transfers': self.g.gp.transfers, 'free_vertices': self.g.gp.free_vertices,
+            'location_lats': self.g.gp.location_lats, 'location_lons': self.g.gp.location_lons}
+
+        for name, prop in self.g.vp.items():
+            arrays['vp.' + name] = prop.a
+
+        for name, prop in self.g.ep.items():
+            arrays['ep.' + name] = prop.a[edges[:, 2]]
+
+        meta = {name: self.g.gp[name] for name in self.saved_objects}
 
-        self.g.save(filename + '.gt')   
+        for name in self.saved_tables:
+            array = table_array(self.g.gp[name])
+            if array is None:
+                meta[name] = self.g.gp[name]
+            else:
+                arrays[name] = array
+
+        for name in self.saved_indexes:
+            arrays.update(object_arrays(name, self.g.gp[name]))
+
+        arrays.update(object_arrays('name_index', self.g.gp.name_index))
+        arrays.update(object_arrays('adjacency', self.get_adjacency()))
+        arrays.update({'connections.' + key: value for key, value in self.get_connections().items()})
+
+        # The arrays may be memory mapped from the files they replace, so all files
+        # are written under temporary names first and then moved into place
+
+        paths = []
+
+        for name, array in arrays.items():
+            path = os.path.join(filename, name + '.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            paths.append(path)
+
+        path = os.path.join(filename, 'meta.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+        paths.append(path)
+
+        for path in paths:
+            os.replace(path + '.tmp', path)
 
 
     def load_from_file(self, filename):
-        
-        self.g = load_graph(filename + '.gt')
 
-        # Transform int back to vertice
-        for loc_id, timestamps in self.g.gp.departure_vertices.items():
-            for t, v in timestamps.items():
-                self.g.gp.departure_vertices[loc_id][t] = self.g.vertex(v)
+        # Loads a graph saved by save_to_file. The graph itself and the id and name
+        # tables are copied into memory. Indexes, transfers and search data stay
+        # memory mapped read only, so processes loading the same files share those
+        # pages through the page cache until an update replaces the arrays.
 
-        for loc_id, timestamps in self.g.gp.arrival_vertices.items():
-            for t, v in timestamps.items():
-                self.g.gp.arrival_vertices[loc_id][t] = self.g.vertex(v)
+        if os.path.isfile(filename):
+            raise ValueError('{} is not a graph directory written by save_to_file. Graphs saved as a single '
+                '.gt file can not be loaded anymore and must be rebuilt.'.format(filename))
 
+        with open(os.path.join(filename, 'meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
 
-    def find_location(self, search_str):
+        arrays = {name[:-4]: np.load(os.path.join(filename, name), mmap_mode='r')
+            for name in os.listdir(filename) if name.endswith('.npy')}
+
+        self.init_graph(meta['begin'], meta['end'], meta['waiting_chains'])
+
+        for name, value in meta.items():
+            self.g.gp[name] = value
+
+        for name in self.saved_tables:
+            if name in arrays:
+                self.g.gp[name] = arrays[name].tolist()
+
+        self.g.gp.location_index = {loc_id: i for i, loc_id in enumerate(self.g.gp.location_ids)}
+        self.g.gp.trip_index = {trip_id: i for i, trip_id in enumerate(self.g.gp.trip_ids)}
+
+        self.g.add_vertex(len(arrays['vp.loc_id']))
+        self.g.add_edge_list(arrays['edges'])
+
+        for name, prop in self.g.vp.items():
+            prop.a[:] = arrays['vp.' + name]
 
-        loc_names = [v['name'] for k, v in self.g.gp.locations.items()]
+        for name, prop in self.g.ep.items():
+            prop.a[:] = arrays['ep.' + name]
 
-        result =  get_close_matches(search_str, loc_names, n=1)
+        self.g.gp.transfers = arrays['transfers']
+        self.g.gp.location_lats = arrays['location_lats']
+        self.g.gp.location_lons = arrays['location_lons']
 
-        if len(result) is 0:
+        if 'free_vertices' in arrays:
+            self.g.gp.free_vertices = arrays['free_vertices']
+
+        for name, cls in self.saved_indexes.items():
+            self.g.gp[name] = object_from_arrays(cls, name, arrays)
+
+        self.g.gp.name_index = object_from_arrays(name_index, 'name_index', arrays)
+        self.g.gp.name_index.names = self.g.gp.location_names
+        self.g.gp.name_index.loc_ids = self.g.gp.location_ids
+
+        self.new_vertices = {}
+        self.index_outdated = False
+        self.reset_search_data()
+
+        self.adjacency = object_from_arrays(adjacency, 'adjacency', arrays)
+        self.connections = {key[len('connections.'):]: value for key, value in arrays.items()
+            if key.startswith('connections.')}
+
+
+    def get_name_index(self):
+
+        if self.g.gp.name_index is None:
+            with self.lock:
+                if self.g.gp.name_index is None:
+                    self.g.gp.name_index = name_index(self.g.gp.location_names, self.g.gp.location_ids)
+
+        return self.g.gp.name_index
+
+
+    def find_location(self, search_str):
+
+        result = self.get_name_index().search(search_str, 1)
+
+        if len(result) == 0:
             return None, None
 
-        loc_name_found = result[0]
+        return result[0]
 
-        loc_id_found = next((x[0] for x in self.g.gp.locations.items() if x[1]['name'] == loc_name_found), None)
 
-        return loc_name_found, loc_id_found
+    def find_locations(self, search_str, k=10):
 
+        # Best k matches as (name, loc_id), for autocompletion
+
+        return self.get_name_index().search(search_str, k)
+
+
+    def boarding_events(self, loc_id, timestamp):
+
+        # Vertices a journey starting at loc_id after timestamp can board from
+
+        if self.g.gp.waiting_chains:
+            timestamps, vertices = self.g.gp.waiting_index.events(loc_id, after=timestamp)
+            return timestamps[:1], vertices[:1]
+
+        return self.g.gp.departure_index.events(loc_id, after=timestamp)
+
+
+    def enable_query_cache(self, max_size=4096, ttl=600):
+
+        # Caches the results of find_shortest_paths and find_path_between_coordinates.
+        # Only queries departing in the same minute share a result, an earlier
+        # departure's paths may board before the requested time. Cached paths are
+        # read only. The cache is cleared whenever the graph changes or is loaded.
+
+        self.query_cache = query_cache(max_size, ttl)
+
+
+    def disable_query_cache(self):
+
+        self.query_cache = None
+
+
+    def query_cache_stats(self):
+
+        # Hits, misses, evictions, expirations, invalidations and size of the query cache
+
+        if self.query_cache is None:
+            return None
+
+        return self.query_cache.stats()
+
+
+    def query_key(self, query, args, dep_time, view):
+
+        # Cache key of a query, None if it is not cached. Queries on views are not
+        # cached, as views are not compared by their vertices.
+
+        if self.query_cache is None or view is not None:
+            return None
 
-    def find_shortest_paths(self, from_loc_id, to_loc_id, dep_time, max_num_paths):
-        
         dep_timestamp = self.timestamp_from_datetime(dep_time)
 
-        origin_vertex = self.g.add_vertex()
-        destination_vertex = self.g.add_vertex()
+        return (query,) + tuple(args) + (dep_timestamp,)
 
-        departure_edges = []
 
-        for t, v in self.g.gp.departure_vertices[from_loc_id].items():
-            if t > dep_timestamp:
-                e = self.g.add_edge(origin_vertex, v)
-                self.g.ep.duration[e] = t - dep_timestamp
-                departure_edges.append(e)
+    def cache_paths(self, key, paths):
 
-        
-        arrival_edges = []
+        # Stores read only copies, so that callers changing the returned paths do
+        # not change the cached ones
 
-        for t, v in self.g.gp.arrival_vertices[to_loc_id].items():
-            e = self.g.add_edge(v, destination_vertex)
-            self.g.ep.duration[e] = 0
-            arrival_edges.append(e)
+        cached = [path.copy() for path in paths]
 
-        
-        shortest_paths = graph_tool.topology.all_shortest_paths(self.g, origin_vertex,
-            destination_vertex, weights=self.g.ep.duration)
+        for path in cached:
+            path.flags.writeable = False
 
-        for e in (departure_edges + arrival_edges):
-            self.g.remove_edge(e)
+        self.query_cache.put(key, cached)
 
-        self.g.remove_vertex([destination_vertex, origin_vertex])        
 
-        result = []
+    def find_shortest_paths(self, from_loc_id, to_loc_id, dep_time, max_num_paths, view=None):
 
-        for i in range(max_num_paths):
-            try:
-                result.append(next(shortest_paths))
-            except StopIteration:
-                break
+        key = self.query_key('shortest_paths', (from_loc_id, to_loc_id, max_num_paths), dep_time, view)
 
-        return result
+        if key is not None:
+            found, paths = self.query_cache.get(key)
+            if found:
+                return list(paths)
+
+        self.update_index()
+
+        dep_timestamp = self.timestamp_from_datetime(dep_time)
+
+        _, sources = self.boarding_events(self.g.gp.location_index[from_loc_id], dep_timestamp)
+
+        _, targets = self.g.gp.arrival_index.events(self.g.gp.location_index[to_loc_id])
+
+        paths = self.find_paths(sources, targets, np.zeros(len(targets)), max_num_paths, view)
+
+        if key is not None:
+            self.cache_paths(key, paths)
+
+        return paths
+
+
+    def time_window_view(self, first_time, last_time):
+
+        # Time window from first_time to last_time, passed as view to restrict the
+        # path searches to the vertices within it. Neither the graph nor a vertex
+        # filter is created.
+
+        first_timestamp = self.timestamp_from_datetime(max(first_time, self.g.gp.begin))
+        last_timestamp = self.timestamp_from_datetime(max(last_time, self.g.gp.begin))
+
+        return time_window(first_timestamp, last_timestamp)
+
+
+    def find_earliest_arrival_paths(self, from_loc_id, to_loc_id, dep_time):
+
+        # Same query as find_shortest_paths with max_num_paths=1, answered by the
+        # connection scan engine. max_transfer_time is ignored, a transfer may wait
+        # for any later departure, so where the limit excludes the earliest journey
+        # this returns an earlier arrival than find_shortest_paths.
+
+        dep_timestamp = self.timestamp_from_datetime(dep_time)
+
+        arr_timestamp, legs = self.get_connection_scan().earliest_arrival(self.g.gp.location_index[from_loc_id],
+            self.g.gp.location_index[to_loc_id], dep_timestamp)
+
+        if arr_timestamp is None:
+            return []
+
+        return [self.path_from_legs(legs)]
+
+
+    def find_earliest_arrivals(self, from_loc_id, dep_time):
+
+        # Earliest arrival timestamp at every location, indexed like gp.location_ids,
+        # np.inf where not reachable. The max transfer time does not apply. Raises
+        # ValueError for a dep_time before begin.
+
+        return self.get_connection_scan().earliest_arrivals(self.g.gp.location_index[from_loc_id],
+            self.departure_timestamp(dep_time))
+
+
+    def find_isochrones(self, from_loc_id, dep_time, time_step=10, max_travel_time=60):
+
+        # Locations reachable within max_travel_time minutes, bucketed by travel
+        # time: bucket i holds the ones reached after i * time_step up to
+        # (i + 1) * time_step minutes, each as a dict with loc_id, name, lat, lon
+        # and travel_time. Raises ValueError for a dep_time before begin.
+
+        travel_times = self.find_earliest_arrivals(from_loc_id, dep_time) - self.departure_timestamp(dep_time)
+
+        num_buckets = int(np.ceil(max_travel_time / time_step))
+        buckets = [[] for i in range(num_buckets)]
+
+        reachable = np.flatnonzero(travel_times <= max_travel_time)
+        bucket_ids = np.minimum(np.maximum(np.ceil(travel_times[reachable] / time_step) - 1, 0), num_buckets - 1)
+
+        for loc_index, bucket_id in zip(reachable.tolist(), bucket_ids.astype(int).tolist()):
+
+            buckets[bucket_id].append({
+                'loc_id': self.g.gp.location_ids[loc_index],
+                'name': self.g.gp.location_names[loc_index],
+                'lat': float(self.g.gp.location_lats[loc_index]),
+                'lon': float(self.g.gp.location_lons[loc_index]),
+                'travel_time': int(travel_times[loc_index])
+                })
+
+        return buckets
+
+
+    def od_matrix(self, from_loc_ids, to_loc_ids, dep_times, processes=None, chunksize=16):
+
+        # Travel times in minutes for all origin, destination and departure time
+        # combinations, as an array of shape (departures, origins, destinations)
+        # with np.inf where not reachable. Each origin and departure time is one
+        # one-to-all scan. Workers are forked after the search data is built and
+        # get the graph and destinations through the pool initializer, so they
+        # share the graph with this process instead of copying it. Raises
+        # ValueError for departure times before begin.
+
+        dep_timestamps = [self.departure_timestamp(dep_time) for dep_time in dep_times]
+
+        from_loc_indices = [self.g.gp.location_index[loc_id] for loc_id in from_loc_ids]
+        to_loc_indices = np.array([self.g.gp.location_index[loc_id] for loc_id in to_loc_ids], dtype=np.int64)
+
+        matrix = np.full((len(dep_timestamps), len(from_loc_indices), len(to_loc_indices)), np.inf)
+
+        tasks = [(i, j, from_loc_index, dep_timestamp)
+            for i, dep_timestamp in enumerate(dep_timestamps)
+            for j, from_loc_index in enumerate(from_loc_indices)]
+
+        self.get_connection_scan()
+
+        if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for time_index, origin_index, travel_times in (od_matrix_row(self, to_loc_indices, task) for task in tasks):
+                matrix[time_index, origin_index] = travel_times
+        else:
+            with multiprocessing.get_context('fork').Pool(processes, od_matrix_init, (self, to_loc_indices)) as pool:
+                for time_index, origin_index, travel_times in pool.imap_unordered(od_matrix_worker_row, tasks, chunksize):
+                    matrix[time_index, origin_index] = travel_times
+
+        return matrix
+
+
+    def find_pareto_paths(self, from_loc_id, to_loc_id, dep_time, max_rounds=5):
+
+        # Journeys that are Pareto optimal in arrival time and number of transfers,
+        # using at most max_rounds trips. Paths are ordered by number of transfers,
+        # each one arriving earlier than the one before. The max transfer time does
+        # not apply.
+
+        dep_timestamp = self.timestamp_from_datetime(dep_time)
+
+        journeys = self.get_raptor().pareto_journeys(self.g.gp.location_index[from_loc_id],
+            self.g.gp.location_index[to_loc_id], dep_timestamp, max_rounds)
+
+        return [self.path_from_trip_legs(legs) for arr_timestamp, legs in journeys]
+
+
+    def find_alternative_paths(self, from_loc_id, to_loc_id, dep_time, k=3, max_slack=30, max_query_time=1.0,
+        max_searches=50):
+
+        # Up to k journeys with different trip sequences, arriving at most max_slack
+        # minutes after the earliest arrival, ordered by arrival. Alternatives are
+        # searched without one more trip of an earlier journey at a time, each trip
+        # sequence is returned once. The query stops searching after max_query_time
+        # seconds, checked between searches, or max_searches searches, which also
+        # bounds the number of kept candidates. The max transfer time does not apply.
+
+        deadline = time.monotonic() + max_query_time
+
+        search = self.get_connection_scan()
+        connections = self.get_connections()
+
+        from_loc_index = self.g.gp.location_index[from_loc_id]
+        to_loc_index = self.g.gp.location_index[to_loc_id]
+        dep_timestamp = self.timestamp_from_datetime(dep_time)
+
+        arr_timestamp, legs = search.earliest_arrival(from_loc_index, to_loc_index, dep_timestamp)
+
+        if arr_timestamp is None:
+            return []
+
+        max_arr_timestamp = arr_timestamp + max_slack
+
+        # Candidates as (arrival, number of legs, search number, legs, excluded trips)
+        candidates = [(arr_timestamp, len(legs), 0, legs, frozenset())]
+        searched = {frozenset()}
+
+        # Trips with the same stop times on a leg make no different journey, so
+        # legs are compared by their board and alight vertices as well
+        sequences = set()
+        journeys = []
+
+        while candidates and len(journeys) < k:
+
+            arr_timestamp, _, _, legs, excluded_trips = heapq.heappop(candidates)
+
+            sequence = tuple(int(connections['trips'][leg[0]]) for leg in legs)
+            events = tuple((int(connections['dep_vertices'][leg[0]]), int(connections['arr_vertices'][leg[-1]]))
+                for leg in legs)
+
+            if sequence in sequences or events in sequences:
+                continue
+
+            sequences.update((sequence, events))
+            journeys.append(legs)
+
+            for trip in sequence:
+
+                if len(searched) > max_searches or time.monotonic() > deadline:
+                    break
+
+                alternative_excluded = excluded_trips | {trip}
+
+                if alternative_excluded in searched:
+                    continue
+
+                searched.add(alternative_excluded)
+
+                arr_timestamp, legs = search.earliest_arrival(from_loc_index, to_loc_index, dep_timestamp,
+                    alternative_excluded)
+
+                if arr_timestamp is not None and arr_timestamp <= max_arr_timestamp:
+                    heapq.heappush(candidates, (arr_timestamp, len(legs), len(searched), legs, alternative_excluded))
+
+        return [self.path_from_legs(legs) for legs in journeys]
+
+
+    def find_profile_paths(self, from_loc_id, to_loc_id, first_dep_time, last_dep_time, max_rounds=5):
+
+        # All journeys departing between first_dep_time and last_dep_time that are
+        # Pareto optimal in departure time, arrival time and number of transfers,
+        # from one range search. Paths are ordered by departure time.
+
+        journeys = self.get_raptor().range_journeys(self.g.gp.location_index[from_loc_id],
+            self.g.gp.location_index[to_loc_id], self.timestamp_from_datetime(first_dep_time),
+            self.timestamp_from_datetime(last_dep_time), max_rounds)
+
+        return [self.path_from_trip_legs(legs) for dep_timestamp, arr_timestamp, legs in journeys]
+
+
+    def path_from_trip_legs(self, legs):
+
+        # Vertices of the trip legs, each leg given as (trip, board position, alight
+        # position) with the trips numbered as in the connections
+
+        trips = self.get_connections()['trips']
+
+        first = np.searchsorted(trips, [trip for trip, _, _ in legs])
+
+        return self.path_from_legs([np.arange(f + board, f + alight) for f, (_, board, alight) in zip(first, legs)])
+
+
+    def path_from_legs(self, legs):
+
+        # Vertices of the trip legs, each leg given by its connections
+
+        connections = self.get_connections()
+
+        path = []
+
+        for leg in legs:
+            path.append(connections['dep_vertices'][leg[:1]])
+            path.append(np.column_stack((connections['arr_vertices'][leg[:-1]],
+                connections['dep_vertices'][leg[1:]])).reshape(-1))
+            path.append(connections['arr_vertices'][leg[-1:]])
+
+        return np.concatenate(path)
 
 
     def find_path_between_coordinates(self, from_lat, from_lon, to_lat, to_lon, dep_time,
-        max_num_paths=1, max_access_distance=250, access_speed=4):
+        max_num_paths=1, max_access_distance=250, access_speed=4, view=None):
 
-        from_loc_access_times = {}
-        to_loc_access_times = {}
+        # Coordinates are rounded to about 10 m in the cache key
+        key = self.query_key('path_between_coordinates', (round(from_lat, 4), round(from_lon, 4), round(to_lat, 4),
+            round(to_lon, 4), max_num_paths, max_access_distance, access_speed), dep_time, view)
 
-        for k, v in self.g.gp.locations.items():
+        if key is not None:
+            found, paths = self.query_cache.get(key)
+            if found:
+                return list(paths)
 
-            distance_from_origin = distance.distance((v['lat'], v['lon']), (from_lat, from_lon)).meters
+        self.update_index()
 
-            if distance_from_origin < max_access_distance:
-                from_loc_access_times[k] = distance_from_origin / 1000 / access_speed * 60
+        from_locs, from_distances = self.g.gp.location_grid.within(from_lat, from_lon, max_access_distance)
+        to_locs, to_distances = self.g.gp.location_grid.within(to_lat, to_lon, max_access_distance)
 
-            distance_to_destination = distance.distance((v['lat'], v['lon']), (to_lat, to_lon)).meters
-            if distance_to_destination < max_access_distance:
-                to_loc_access_times[k] = distance_to_destination / 1000 / access_speed * 60
+        from_loc_access_times = dict(zip(from_locs.tolist(), (from_distances / 1000 / access_speed * 60).tolist()))
+        to_loc_access_times = dict(zip(to_locs.tolist(), (to_distances / 1000 / access_speed * 60).tolist()))
 
         dep_timestamp = self.timestamp_from_datetime(dep_time)
 
-        origin_vertex = self.g.add_vertex()
-        destination_vertex = self.g.add_vertex()
+        sources = [np.zeros(0, dtype=np.int64)]
+        targets = [np.zeros(0, dtype=np.int64)]
+        target_costs = [np.zeros(0)]
 
-        departure_edges = []
+        for from_loc_index, access_time in from_loc_access_times.items():
 
-        for from_loc_id, access_time in from_loc_access_times.items():
-            for t, v in self.g.gp.departure_vertices[from_loc_id].items():
-                if t > dep_timestamp + access_time:
-                    e = self.g.add_edge(origin_vertex, v)
-                    self.g.ep.duration[e] = t - dep_timestamp
-                    departure_edges.append(e)
+            _, vertices = self.boarding_events(from_loc_index, dep_timestamp + access_time)
+            sources.append(vertices)
 
-        
-        arrival_edges = []
+        for to_loc_index, access_time in to_loc_access_times.items():
 
-        for to_loc_id, access_time in to_loc_access_times.items():
-            for t, v in self.g.gp.arrival_vertices[to_loc_id].items():
-                e = self.g.add_edge(v, destination_vertex)
-                self.g.ep.duration[e] = access_time
-                arrival_edges.append(e)
+            _, vertices = self.g.gp.arrival_index.events(to_loc_index)
+            targets.append(vertices)
+            target_costs.append(np.full(len(vertices), access_time))
 
-        
-        shortest_paths = graph_tool.topology.all_shortest_paths(self.g, origin_vertex,
-            destination_vertex, weights=self.g.ep.duration)
+        paths = self.find_paths(np.concatenate(sources), np.concatenate(targets),
+            np.concatenate(target_costs), max_num_paths, view)
 
-        for e in (departure_edges + arrival_edges):
-            self.g.remove_edge(e)
+        if key is not None:
+            self.cache_paths(key, paths)
 
-        self.g.remove_vertex([destination_vertex, origin_vertex])        
+        return paths
+
+
+    def find_paths(self, sources, targets, target_costs, max_num_paths, view=None):
+
+        # Up to max_num_paths paths from any source vertex to the target vertices with
+        # the lowest timestamp + target cost. The graph is only read, so queries can
+        # run concurrently on one graph. With a time_window from time_window_view or
+        # a vertex filtered view of the graph, only its vertices are searched.
 
         result = []
 
-        for i in range(max_num_paths):
-            try:
-                result.append(next(shortest_paths))
-            except StopIteration:
-                break
+        if len(sources) == 0 or len(targets) == 0:
+            return result
 
-        return result
+        timestamps = self.g.vp.timestamp.a
 
+        search = self.get_adjacency()
 
-    def path_to_string_with_all_stops(self, path):
+        allowed = None
 
-        result = ''
+        if isinstance(view, time_window):
+            allowed = view
+        elif view is not None:
+            vertex_filter, inverted = view.get_vertex_filter()
+            if vertex_filter is not None:
+                allowed = vertex_filter.a.astype(bool) != inverted
 
-        for i in range(1, len(path) - 1):
+        reached, best_cost = search.reach(sources, targets, target_costs, timestamps, self.search_time_step, allowed)
 
-            time = self.datetime_from_timestamp(self.g.vp.timestamp[path[i]])
-            loc = self.g.gp.locations[str(self.g.vp.loc_id[path[i]])]['name']
+        if best_cost == np.inf:
+            return result
 
-            if self.g.vp.is_departure[path[i]]:
+        is_best = reached[targets] & (timestamps[targets] + target_costs == best_cost)
 
-                trip_name = self.g.gp.trips[self.g.ep.trip_id[(path[i], path[i+1])]]['name']
-                result += '{} DEP {} {}\n'.format(time, trip_name, loc)
+        source_set = set(np.asarray(sources).tolist())
 
-            else:
+        for target in np.unique(targets[is_best]).tolist():
+            for path in search.iterate_paths(target, reached, source_set):
+                result.append(path)
+                if len(result) == max_num_paths:
+                    return result
 
-                trip_name = self.g.gp.trips[self.g.ep.trip_id[(path[i-1], path[i])]]['name']
-                result += '{} ARR {} {}\n'.format(time, trip_name, loc)
-            
         return result
 
 
-    def path_to_string(self, path):
+    def decode_paths(self, paths, as_dataframe=False):
+
+        # Trip legs of a batch of paths, with all properties gathered by array
+        # indexing. Returns one record per leg with the number of its path and
+        # of the leg within the path, trip id and name, and location id, name
+        # and time of boarding and alighting, or the same columns as a DataFrame.
+
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        vertices = np.concatenate([np.asarray(path, dtype=np.int64) for path in paths] + [np.zeros(0, dtype=np.int64)])
+        path_numbers = np.repeat(np.arange(len(paths)), lengths)
+
+        # Consecutive vertices of the same path
+        is_pair = path_numbers[:-1] == path_numbers[1:]
+        sources = vertices[:-1][is_pair]
+        targets = vertices[1:][is_pair]
+        pair_paths = path_numbers[:-1][is_pair]
+
+        trips = self.pair_trips(sources, targets, pair_paths)
+
+        # A leg is a run of transport edges of the same trip within a path
+        continues = np.zeros(len(trips), dtype=bool)
+        continues[1:] = (trips[1:] == trips[:-1]) & (pair_paths[1:] == pair_paths[:-1])
+
+        is_transport = trips >= 0
+        starts = np.flatnonzero(is_transport & ~continues)
+        ends = np.flatnonzero(is_transport & ~np.append(continues[1:], False))
+
+        leg_paths = pair_paths[starts]
+        leg_trips = trips[starts].tolist()
+
+        board_vertices = sources[starts]
+        alight_vertices = targets[ends]
+
+        board_locs = self.g.vp.loc_id.a[board_vertices].tolist()
+        alight_locs = self.g.vp.loc_id.a[alight_vertices].tolist()
+
+        begin = np.datetime64(self.g.gp.begin, 'm')
+
+        columns = {
+            'path': leg_paths,
+            'leg': np.arange(len(starts)) - np.searchsorted(leg_paths, leg_paths),
+            'trip_id': [self.g.gp.trip_ids[trip] for trip in leg_trips],
+            'trip_name': [self.g.gp.trip_names[trip] for trip in leg_trips],
+            'board_loc_id': [self.g.gp.location_ids[loc] for loc in board_locs],
+            'board_name': [self.g.gp.location_names[loc] for loc in board_locs],
+            'board_time': begin + self.g.vp.timestamp.a[board_vertices].astype('timedelta64[m]'),
+            'alight_loc_id': [self.g.gp.location_ids[loc] for loc in alight_locs],
+            'alight_name': [self.g.gp.location_names[loc] for loc in alight_locs],
+            'alight_time': begin + self.g.vp.timestamp.a[alight_vertices].astype('timedelta64[m]')
+            }
+
+        if as_dataframe:
+            import pandas as pd
+            return pd.DataFrame(columns)
+
+        values = [column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()]
+
+        return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+    def path_to_string_with_all_stops(self, path):
+
+        path = np.asarray(path, dtype=np.int64)
+        path = path[~self.g.vp.is_waiting.a[path].astype(bool)]
+
+        # Departures are followed and arrivals preceded by the edge of their trip
+        is_departure = self.g.vp.is_departure.a[path].astype(bool)
+        trips = self.pair_trips(path[:-1], path[1:])
+        trips = np.where(is_departure, np.append(trips, -1), np.insert(trips, 0, -1)).tolist()
+
+        times = (np.datetime64(self.g.gp.begin, 'm') + self.g.vp.timestamp.a[path].astype('timedelta64[m]')).tolist()
+        locs = self.g.vp.loc_id.a[path].tolist()
 
         result = ''
 
-        current_trip = ''
+        for time, loc, trip, departure in zip(times, locs, trips, is_departure.tolist()):
 
-        for i in range(1, len(path) - 1):
+            trip_name = self.g.gp.trip_names[trip] if trip >= 0 else ''
 
-            time = self.datetime_from_timestamp(self.g.vp.timestamp[path[i]])
-            loc = self.g.gp.locations[str(self.g.vp.loc_id[path[i]])]['name']
+            result += '{} {} {} {}\n'.format(time, 'DEP' if departure else 'ARR', trip_name,
+                self.g.gp.location_names[loc])
 
-            if self.g.vp.is_departure[path[i]]:
+        return result
 
-                trip_name = self.g.gp.trips[self.g.ep.trip_id[(path[i], path[i+1])]]['name']
 
-                if trip_name != current_trip:
-                    current_trip = trip_name
-                    result += '{} DEP {} {}\n'.format(time, trip_name, loc)
+    def path_to_string(self, path):
 
-            else:
+        result = ''
 
-                if i == len(path) - 2:
-                    result += '{} ARR {} {}\n'.format(time, current_trip, loc)
-                    return result
+        for leg in self.decode_paths([path]):
+            result += '{} DEP {} {}\n'.format(leg['board_time'], leg['trip_name'], leg['board_name'])
+            result += '{} ARR {} {}\n'.format(leg['alight_time'], leg['trip_name'], leg['alight_name'])
 
-                if self.g.ep.is_transfer[(path[i], path[i+1])]:
-                    result += '{} ARR {} {}\n'.format(time, current_trip, loc)
-            
         return result
@@ -0,0 +1,117 @@
+import io
+import os
+import contextlib
+import json
+import gzip
+
+def is_trip_file(filename):
+
+    # Trip files are line-delimited JSON (.ndjson or .jsonl), optionally
+    # compressed (.gz or .zst)
+
+    for suffix in ('.gz', '.zst'):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+
+    return filename.endswith('.ndjson') or filename.endswith('.jsonl')
+
+
+class trip_file:
+
+    # Trips stored one per line as {"trip_name": ..., "stops": [...]}, read and
+    # written as a stream so that no more than one trip is held in memory. Trip
+    # names without any trips are not stored.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+
+    def open_file(self, mode, filename=None):
+
+        # Text stream for mode 'r' or 'w' of the file, or of filename compressed
+        # like the file, compressed by the suffix
+
+        if filename is None:
+            filename = self.filename
+
+        if self.filename.endswith('.gz'):
+            return gzip.open(filename, mode + 't', encoding='utf-8')
+
+        if self.filename.endswith('.zst'):
+            # Only needed for zstd compressed files, from the zstandard package
+            import zstandard
+
+            f = open(filename, mode + 'b')
+
+            if mode == 'r':
+                stream = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+            else:
+                stream = zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+
+            return io.TextIOWrapper(stream, encoding='utf-8')
+
+        return open(filename, mode, encoding='utf-8')
+
+
+    def read(self):
+
+        # Generator of (trip_name, trip) in the order the trips were written
+
+        with self.open_file('r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['trip_name'], record['stops']
+
+
+    def items(self):
+
+        # Trips as (trip_name, [trip]) like the items of a trips dict, so that a
+        # trip file can be used in place of one. Each call reads the file again.
+
+        for trip_name, trip in self.read():
+            yield trip_name, [trip]
+
+
+    def open(self):
+
+        # Starts writing the file, replacing an existing one
+
+        self.file = self.open_file('w')
+
+
+    def write_trip(self, trip_name, trip, f=None):
+
+        (self.file if f is None else f).write(json.dumps({'trip_name': trip_name, 'stops': trip}) + '\n')
+
+
+    def write(self, trips):
+
+        # Writes a trips dict or the trips of another trip_file. The trips are
+        # written to a temporary file which replaces the file once they have all
+        # been read, so a trip_file may also be written to the file it reads.
+
+        if isinstance(trips, trip_file) and os.path.abspath(trips.filename) == os.path.abspath(self.filename):
+            return
+
+        temp_filename = os.path.join(os.path.dirname(self.filename), '.tmp-' + os.path.basename(self.filename))
+
+        try:
+            with self.open_file('w', temp_filename) as f:
+                for trip_name, trip_list in trips.items():
+                    for trip in trip_list:
+                        self.write_trip(trip_name, trip, f)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_filename)
+            raise
+
+        os.replace(temp_filename, self.filename)
+
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None